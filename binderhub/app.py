@@ -20,20 +20,24 @@ import tornado.options
 import tornado.log
 from tornado.log import app_log
 import tornado.web
-from traitlets import Unicode, Integer, Bool, Dict, validate, TraitError, default
+from traitlets import Unicode, Integer, Bool, Dict, Enum, validate, TraitError, default
 from traitlets.config import Application
 from jupyterhub.services.auth import HubOAuthCallbackHandler
 
 from .base import Custom404
-from .build import Build
-from .builder import BuildHandler
+from .batch import BatchLaunchHandler
+from .build import Build, BuildCleaner
+from .builder import BuildHandler, EventStreamCompression
 from .launcher import Launcher
 from .registry import DockerRegistry
+from .quota import LaunchQuota, QuotaTiers
+from .status import BuildStatusHandler
 from .main import MainHandler, ParameterizedMainHandler, LegacyRedirectHandler
 from .repoproviders import GitHubRepoProvider, GitRepoProvider, GitLabRepoProvider, GistRepoProvider
 from .metrics import MetricsHandler
 from .utils import ByteSpecification, url_path_join
 from .events import EventLog
+from .webhook import WebhookHandler
 
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -181,6 +185,109 @@ class BinderHub(Application):
         config=True,
     )
 
+    per_repo_quota_file = Unicode(
+        '',
+        help="""
+        Path to a JSON file with quotas for specific repos or organizations.
+
+        Each tier has a regular expression matched against repo identities,
+        such as ``github.com/org/repo``, and the quota for matching repos::
+
+            {
+              "tiers": [
+                {"pattern": "github.com/my-course/", "quota": 500},
+                {"pattern": "github.com/org/repo$", "quota": 0}
+              ]
+            }
+
+        The first matching tier applies, and a quota of 0 means no quota.
+        Other repos get per_repo_quota, or the file's "default" if it has one.
+        The file is reloaded when it changes.
+        """,
+        config=True,
+    )
+
+    per_repo_quota_max_wait = Integer(
+        300,
+        help="""
+        Maximum time (seconds) a launch waits for a repo to be below per_repo_quota.
+
+        Launches of a repo over its quota wait in a queue,
+        and are told their position in it,
+        until a server running the repo stops.
+        Launches that are still waiting after this time fail.
+
+        0 means launches fail immediately if the repo is over its quota.
+        """,
+        config=True,
+    )
+
+    max_repo_size = ByteSpecification(
+        0,
+        help="""
+        Maximum size of a repository to build, as reported by its repo provider.
+
+        Repos larger than this fail before a build pod is started.
+        Repos whose provider doesn't report a size are always built.
+
+        0 (default) means no limit.
+        """,
+        config=True,
+    )
+
+    compress_event_streams = Bool(
+        False,
+        help="""
+        Compress /build event streams with gzip or deflate,
+        for clients that accept it.
+
+        Build logs can be several MB per stream and compress well.
+        Each write is flushed, so events are still delivered as they happen.
+        """,
+        config=True,
+    )
+
+    stale_if_error = Bool(
+        False,
+        help="""
+        Keep launching when a repo provider or the registry is unavailable.
+
+        If resolving a ref fails, the last successfully resolved ref
+        for the same spec is used instead, if there is one.
+        If checking the registry fails, images that were recently found
+        are assumed to still be there.
+        Events sent in this mode are flagged with ``degraded: true``.
+        """,
+        config=True,
+    )
+
+    batch_api_tokens = Dict(
+        help="""
+        API tokens allowed to launch batches of servers, e.g. for workshops.
+
+        Keys are tokens, values are names used in logs.
+        Tokens are sent in an ``Authorization: token <token>`` header
+        to ``/batch/<provider>/<spec>?count=<n>``.
+
+        Batch launches are disabled if no tokens are configured.
+        """,
+        config=True,
+    )
+
+    batch_launch_max_count = Integer(
+        100,
+        help="Maximum number of servers launched by a single batch request.",
+        config=True,
+    )
+
+    batch_launch_concurrency = Integer(
+        10,
+        help="""
+        Maximum number of servers of a batch that are launched at the same time.
+        """,
+        config=True,
+    )
+
     log_tail_lines = Integer(
         100,
         help="""
@@ -319,6 +426,20 @@ class BinderHub(Application):
         config=True
     )
 
+    builder_image_pull_policy = Enum(
+        ['Always', 'IfNotPresent', 'Never'],
+        'Always',
+        help="""
+        The image pull policy of the builder image.
+
+        With 'Always', starting a build pod checks the registry for a new version
+        of the builder image. If builder_image_spec is a fixed tag and the image
+        is pulled in advance on the build nodes (as the Helm chart does),
+        'IfNotPresent' lets builds start without that round trip.
+        """,
+        config=True
+    )
+
     build_node_selector = Dict(
         {},
         config=True,
@@ -327,6 +448,78 @@ class BinderHub(Application):
         """
     )
 
+    sticky_builds = Bool(
+        False,
+        help="""
+        Prefer to run builds of a repo on the node that built it last.
+
+        The Docker layer cache of that node likely has most of the layers
+        of the new build, making it faster.
+        The node is a preference, builds still run elsewhere if it is busy.
+        """,
+        config=True,
+    )
+
+    reuse_environment_images = Bool(
+        False,
+        help="""
+        Reuse the layers of images of a repo with the same environment.
+
+        Before building, the files that define the repo's environment
+        (requirements.txt, environment.yml, the binder directory, ...)
+        are hashed, using the provider's API.
+        If an image of the repo was built from the same files, it is passed to
+        repo2docker as ``--cache-from``, so only the layers with the repo's
+        contents are rebuilt. This requires a builder image with a version
+        of repo2docker that supports ``--cache-from``.
+
+        Docker only uses images present on the build node as a cache,
+        so this works best together with sticky_builds.
+        """,
+        config=True,
+    )
+
+    build_cancel_timeout = Integer(
+        0,
+        help="""
+        Time (in seconds) after which a build no one is watching is deleted.
+
+        A build is watched while a client is connected to its event stream,
+        or has disconnected for less than 30 seconds and may resume it.
+        Builds that are pushing their image are left to finish.
+
+        Watchers are counted by each BinderHub process,
+        so only enable this when running a single replica:
+        with more replicas, a build watched through another replica
+        would be deleted.
+
+        0 (default) means builds run until they finish or reach build_max_age.
+        """,
+        config=True,
+    )
+
+    build_pod_overrides = Dict(
+        {},
+        config=True,
+        help="""
+        Changes to the build pods, as a pod manifest.
+
+        Merged into the pod template built from the other build settings,
+        e.g. to add tolerations, annotations or volumes::
+
+            {
+                "spec": {
+                    "tolerations": [{"key": "builds", "operator": "Exists"}],
+                    "containers": [{"name": "builder", "env": [{"name": "HTTP_PROXY", "value": "..."}]}],
+                }
+            }
+
+        Lists of items with a name (containers, volumes, env, ...) are merged by name,
+        other values are replaced.
+        The template is validated on startup.
+        """
+    )
+
     repo_providers = Dict(
         {
             'gh': GitHubRepoProvider,
@@ -355,9 +548,13 @@ class BinderHub(Application):
         """,
     )
     build_cleanup_interval = Integer(
-        60,
+        300,
         config=True,
-        help="""Interval (in seconds) for how often stopped build pods will be deleted."""
+        help="""Interval (in seconds) for how often all build pods are listed again.
+
+        Build pods are deleted as soon as they stop, from a watch.
+        Listing them again catches changes the watch may have missed.
+        """
     )
     build_max_age = Integer(
         3600 * 4,
@@ -455,6 +652,8 @@ class BinderHub(Application):
             except kubernetes.config.ConfigException:
                 kubernetes.config.load_kube_config()
             self.tornado_settings["kubernetes_client"] = self.kube_client = kubernetes.client.CoreV1Api()
+            self.launch_quota = LaunchQuota(self.kube_client, self.build_namespace)
+            self.tornado_settings['launch_quota'] = self.launch_quota
 
 
         # times 2 for log + build threads
@@ -483,12 +682,33 @@ class BinderHub(Application):
         else:
             registry = None
 
+        if self.builder_required:
+            # the parts of build pods that don't change between builds
+            build_pod_template = Build.make_pod_template(
+                builder_image=self.builder_image_spec,
+                image_pull_policy=self.builder_image_pull_policy,
+                push_secret=self.docker_push_secret if self.use_registry else None,
+                memory_limit=self.build_memory_limit,
+                docker_host=self.build_docker_host,
+                node_selector=self.build_node_selector,
+                overrides=self.build_pod_overrides,
+            )
+        else:
+            build_pod_template = None
+
         self.launcher = Launcher(
             parent=self,
             hub_url=self.hub_url,
             hub_api_token=self.hub_api_token,
             create_user=not self.auth_enabled,
         )
+        if self.builder_required:
+            self.launch_quota.unclaimed_servers = self.launcher.unclaimed_warm_servers
+
+        if self.per_repo_quota_file:
+            quota_tiers = QuotaTiers(self.per_repo_quota_file, default=self.per_repo_quota)
+        else:
+            quota_tiers = None
 
         self.event_log = EventLog(parent=self)
 
@@ -505,9 +725,20 @@ class BinderHub(Application):
             "build_namespace": self.build_namespace,
             "builder_image_spec": self.builder_image_spec,
             'build_node_selector': self.build_node_selector,
+            'build_pod_template': build_pod_template,
+            'sticky_builds': self.sticky_builds,
+            'reuse_environment_images': self.reuse_environment_images,
+            'build_cancel_timeout': self.build_cancel_timeout,
             'build_pool': self.build_pool,
             'log_tail_lines': self.log_tail_lines,
             'per_repo_quota': self.per_repo_quota,
+            'per_repo_quota_max_wait': self.per_repo_quota_max_wait,
+            'quota_tiers': quota_tiers,
+            'stale_if_error': self.stale_if_error,
+            'max_repo_size': self.max_repo_size,
+            'batch_api_tokens': self.batch_api_tokens,
+            'batch_launch_max_count': self.batch_launch_max_count,
+            'batch_launch_concurrency': self.batch_launch_concurrency,
             'repo_providers': self.repo_providers,
             'use_registry': self.use_registry,
             'registry': registry,
@@ -533,6 +764,9 @@ class BinderHub(Application):
         handlers = [
             (r'/metrics', MetricsHandler),
             (r"/build/([^/]+)/(.+)", BuildHandler),
+            (r"/batch/([^/]+)/(.+)", BatchLaunchHandler),
+            (r"/api/builds/([^/]+)/(.+)", BuildStatusHandler),
+            (r"/hooks/([^/]+)", WebhookHandler),
             (r"/v2/([^/]+)/(.+)", ParameterizedMainHandler),
             (r"/repo/([^/]+)/([^/]+)(/.*)?", LegacyRedirectHandler),
             # for backward-compatible mybinder.org badge URLs
@@ -568,32 +802,15 @@ class BinderHub(Application):
             oauth_redirect_uri = urlparse(oauth_redirect_uri).path
             handlers.insert(-1, (oauth_redirect_uri, HubOAuthCallbackHandler))
         self.tornado_app = tornado.web.Application(handlers, **self.tornado_settings)
+        if self.compress_event_streams:
+            self.tornado_app.add_transform(EventStreamCompression)
 
     def stop(self):
         self.http_server.stop()
         self.build_pool.shutdown()
-
-    async def watch_build_pods(self):
-        """Watch build pods
-
-        Every build_cleanup_interval:
-        - delete stopped build pods
-        - delete running build pods older than build_max_age
-        """
-        while True:
-            try:
-                await asyncio.wrap_future(
-                    self.executor.submit(
-                        lambda: Build.cleanup_builds(
-                            self.kube_client,
-                            self.build_namespace,
-                            self.build_max_age,
-                        )
-                    )
-                )
-            except Exception:
-                app_log.exception("Failed to cleanup build pods")
-            await asyncio.sleep(self.build_cleanup_interval)
+        if self.builder_required:
+            self.build_cleaner.stop()
+            self.launch_quota.stop()
 
     def start(self, run_loop=True):
         self.log.info("BinderHub starting on port %i", self.port)
@@ -603,7 +820,17 @@ class BinderHub(Application):
         )
         self.http_server.listen(self.port)
         if self.builder_required:
-            asyncio.ensure_future(self.watch_build_pods())
+            self.build_cleaner = BuildCleaner(
+                self.kube_client,
+                self.build_namespace,
+                max_age=self.build_max_age,
+                executor=self.executor,
+                resync_interval=self.build_cleanup_interval,
+            )
+            self.build_cleaner.start()
+            self.launch_quota.start()
+        if self.launcher.create_user and self.launcher.user_pool_size:
+            asyncio.ensure_future(self.launcher.fill_user_pool())
         if run_loop:
             tornado.ioloop.IOLoop.current().start()
 
@@ -0,0 +1,140 @@
+"""
+Handler for launching many servers of one repo at once, e.g. for workshops
+"""
+import hmac
+import time
+
+from tornado import web
+from tornado.log import app_log
+from tornado.web import authenticated
+
+from .builder import BuildHandler, LAUNCH_COUNT
+from .launcher import observe_launch_stage
+from .quota import image_repo
+
+
+class BatchLaunchHandler(BuildHandler):
+    """Build a repo once and launch many servers from it
+
+    The ref is resolved, the image is looked up (or built) and the quota
+    is checked once for the whole batch.
+    Progress of all the launches is sent as a single event stream,
+    ending with a 'ready' event containing the url and token of each server.
+
+    Requests are authenticated with one of ``BinderHub.batch_api_tokens``
+    in an ``Authorization: token <token>`` header.
+    """
+
+    url_prefix = '/batch/'
+
+    def check_xsrf_cookie(self):
+        """Batch launches are authenticated by a token, not cookies"""
+        pass
+
+    def get_current_user(self):
+        auth_header = self.request.headers.get('Authorization', '')
+        scheme, _, token = auth_header.partition(' ')
+        if scheme.lower() != 'token' or not token:
+            return None
+        for known_token, name in self.settings['batch_api_tokens'].items():
+            if hmac.compare_digest(token.strip(), known_token):
+                return name
+        return None
+
+    async def get(self, provider_prefix, _unescaped_spec):
+        raise web.HTTPError(405)
+
+    @authenticated
+    async def post(self, provider_prefix, _unescaped_spec):
+        """Launch ``?count=<n>`` servers for a given spec and repo provider"""
+        try:
+            count = int(self.get_argument('count', '1'))
+        except ValueError:
+            raise web.HTTPError(400, "count must be an integer")
+        max_count = self.settings['batch_launch_max_count']
+        if not 0 < count <= max_count:
+            raise web.HTTPError(400, "count must be between 1 and %i" % max_count)
+        self.batch_count = count
+        app_log.info("Batch launch of %i servers for %s requested by %s",
+            count, self.request.path, self.current_user)
+        await super().get(provider_prefix, _unescaped_spec)
+
+    async def launch(self, kube, just_built=False):
+        """Ask JupyterHub to launch `batch_count` servers of the image"""
+        stage_start = time.perf_counter()
+        count = self.batch_count
+        quota = self.get_repo_quota()
+        launch_quota = self.settings['launch_quota']
+        repo = image_repo(self.image_name)
+        if quota:
+            if count > quota:
+                admitted = False
+            else:
+                # reserve the whole batch, so launches of the repo
+                # can't take its slots while the batch is starting
+                admitted = await launch_quota.acquire(
+                    repo, quota,
+                    timeout=self.settings['per_repo_quota_max_wait'],
+                    position_callback=self.emit_quota_position,
+                    count=count,
+                )
+            if not admitted:
+                matching_pods = launch_quota.count(repo)
+                app_log.error("Batch of %s for %s would exceed quota: %s+%s/%s (%s total)",
+                    count, self.repo_url, matching_pods, count, quota, launch_quota.total)
+                await self.fail("Launching %i servers of %s would exceed its quota of %i (%i running)."
+                    % (count, self.repo_url, quota, matching_pods))
+                return
+        observe_launch_stage('quota_check', stage_start, just_built)
+
+        await self.emit({
+            'phase': 'launching',
+            'message': 'Launching %i servers...\n' % count,
+            'count': count,
+        })
+
+        async def emit_progress(launched, failed):
+            await self.emit({
+                'phase': 'launching',
+                'message': '%i/%i servers launched, %i failed\n' % (launched, count, failed),
+                'count': count,
+                'launched': launched,
+                'failed': failed,
+            })
+
+        launcher = self.settings['launcher']
+        try:
+            servers = await launcher.launch_batch(
+                self.image_name, count,
+                repo_url=self.repo_url,
+                concurrency=self.settings['batch_launch_concurrency'],
+                progress_callback=emit_progress,
+                just_built=just_built,
+            )
+        finally:
+            if quota:
+                launch_quota.release(repo, count)
+        failed = count - len(servers)
+        if servers:
+            LAUNCH_COUNT.labels(status='success', **self.repo_metric_labels).inc(len(servers))
+        if failed:
+            LAUNCH_COUNT.labels(status='failure', **self.repo_metric_labels).inc(failed)
+        if not servers:
+            await self.fail("Failed to launch any servers of %s" % self.image_name)
+            return
+
+        event = {
+            'phase': 'ready',
+            'message': '%i/%i servers running\n' % (len(servers), count),
+            'count': count,
+            'failed': failed,
+            'servers': [
+                {'url': server_info['url'], 'token': server_info['token']}
+                for server_info in servers
+            ],
+        }
+        if self.degraded:
+            event['degraded'] = True
+        await self.emit(event)
+        # the client is a script, not an EventSource, so there's no need to linger
+        self.finish()
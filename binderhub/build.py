@@ -3,15 +3,49 @@ Contains build of a docker image from a git repository.
 """
 
 from collections import defaultdict
-import datetime
+import copy
+import heapq
 import json
 import threading
+import time
+from types import SimpleNamespace
 from urllib.parse import urlparse
 
 from kubernetes import client, watch
 from tornado.ioloop import IOLoop
 from tornado.log import app_log
 
+from .utils import PodWatcher
+
+
+def merge_pod_manifest(base, overrides):
+    """Merge `overrides` into a pod manifest, returning a new manifest
+
+    Dicts are merged recursively.
+    Lists of items with a name (containers, volumes, env, ...) are merged
+    by name, so the "builder" container can be changed or other containers added.
+    Other values, including other lists, are replaced.
+    """
+    if isinstance(base, dict) and isinstance(overrides, dict):
+        merged = dict(base)
+        for key, value in overrides.items():
+            merged[key] = merge_pod_manifest(base[key], value) if key in base else value
+        return merged
+    if (
+        isinstance(base, list) and isinstance(overrides, list)
+        and all(isinstance(item, dict) and 'name' in item for item in base + overrides)
+    ):
+        merged = list(base)
+        names = [item['name'] for item in base]
+        for item in overrides:
+            if item['name'] in names:
+                i = names.index(item['name'])
+                merged[i] = merge_pod_manifest(merged[i], item)
+            else:
+                merged.append(item)
+        return merged
+    return overrides
+
 
 class Build:
     """Represents a build of a git repository into a docker image.
@@ -36,7 +70,8 @@ class Build:
     """
     def __init__(self, q, api, name, namespace, repo_url, ref, git_credentials, builder_image,
                  image_name, push_secret, memory_limit, docker_host, node_selector,
-                 appendix='', log_tail_lines=100):
+                 appendix='', log_tail_lines=100, pod_template=None, preferred_node=None,
+                 cache_from=None):
         self.q = q
         self.api = api
         self.repo_url = repo_url
@@ -55,6 +90,13 @@ class Build:
 
         self.stop_event = threading.Event()
         self.git_credentials = git_credentials
+        # the parts of the pod that are the same for all builds,
+        # see make_pod_template
+        self.pod_template = pod_template
+        # the node that built this repo before, which has its layers cached
+        self.preferred_node = preferred_node
+        # an image of the same repo with the same environment, whose layers can be reused
+        self.cache_from = cache_from
 
     def get_cmd(self):
         """Get the cmd to run to build the image"""
@@ -76,6 +118,9 @@ class Build:
             cmd.append('--build-memory-limit')
             cmd.append(str(self.memory_limit))
 
+        if self.cache_from:
+            cmd.extend(['--cache-from', self.cache_from])
+
         # repo_url comes at the end, since otherwise our arguments
         # might be mistook for commands to run.
         # see https://github.com/jupyter/repo2docker/pull/128
@@ -83,120 +128,145 @@ class Build:
 
         return cmd
 
-    @classmethod
-    def cleanup_builds(cls, kube, namespace, max_age):
-        """Delete stopped build pods and build pods that have aged out"""
-        builds = kube.list_namespaced_pod(
-            namespace=namespace,
-            label_selector='component=binderhub-build',
-        ).items
-        phases = defaultdict(int)
-        app_log.debug("%i build pods", len(builds))
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
-        start_cutoff = now - datetime.timedelta(seconds=max_age)
-        deleted = 0
-        for build in builds:
-            phase = build.status.phase
-            phases[phase] += 1
-            annotations = build.metadata.annotations or {}
-            repo = annotations.get("binder-repo", "unknown")
-            delete = False
-            if build.status.phase in {'Failed', 'Succeeded', 'Evicted'}:
-                # log Deleting Failed build build-image-...
-                # print(build.metadata)
-                app_log.info(
-                    "Deleting %s build %s (repo=%s)",
-                    build.status.phase,
-                    build.metadata.name,
-                    repo,
-                )
-                delete = True
-            else:
-                # check age
-                started = build.status.start_time
-                if max_age and started and started < start_cutoff:
-                    app_log.info(
-                        "Deleting long-running build %s (repo=%s)",
-                        build.metadata.name,
-                        repo,
-                    )
-                    delete = True
-
-            if delete:
-                deleted += 1
-                try:
-                    kube.delete_namespaced_pod(
-                        name=build.metadata.name,
-                        namespace=namespace,
-                        body=client.V1DeleteOptions(grace_period_seconds=0))
-                except client.rest.ApiException as e:
-                    if e.status == 404:
-                        # Is ok, someone else has already deleted it
-                        pass
-                    else:
-                        raise
-
-        if deleted:
-            app_log.info("Deleted %i/%i build pods", deleted, len(builds))
-        app_log.debug("Build phase summary: %s", json.dumps(phases, sort_keys=True, indent=1))
-
     def progress(self, kind, obj):
         """Put the current action item into the queue for execution."""
         self.main_loop.add_callback(self.q.put, {'kind': kind, 'payload': obj})
 
-    def submit(self):
-        """Submit a image spec to openshift's s2i and wait for completion """
+    @classmethod
+    def make_pod_template(cls, builder_image, push_secret, memory_limit, docker_host,
+                          node_selector, image_pull_policy='Always', overrides=None):
+        """Make the parts of a build pod that are the same for all builds
+
+        Returns a V1Pod with a container named "builder",
+        to which each build adds its name, labels, args and env.
+
+        `overrides` is a pod manifest, as accepted by the Kubernetes API,
+        merged into the template (see merge_pod_manifest).
+        The result is validated, so mistakes in it are found when this is called,
+        not when a build pod is created.
+        """
         volume_mounts = [
             client.V1VolumeMount(mount_path="/var/run/docker.sock", name="docker-socket")
         ]
-        docker_socket_path = urlparse(self.docker_host).path
+        docker_socket_path = urlparse(docker_host).path
         volumes = [client.V1Volume(
             name="docker-socket",
             host_path=client.V1HostPathVolumeSource(path=docker_socket_path, type='Socket')
         )]
 
-        if self.push_secret:
+        if push_secret:
             volume_mounts.append(client.V1VolumeMount(mount_path="/root/.docker", name='docker-push-secret'))
             volumes.append(client.V1Volume(
                 name='docker-push-secret',
-                secret=client.V1SecretVolumeSource(secret_name=self.push_secret)
+                secret=client.V1SecretVolumeSource(secret_name=push_secret)
             ))
 
-        env = []
-        if self.git_credentials:
-            env.append(client.V1EnvVar(name='GIT_CREDENTIAL_ENV', value=self.git_credentials))
-
-        self.pod = client.V1Pod(
+        pod = client.V1Pod(
             metadata=client.V1ObjectMeta(
-                name=self.name,
                 labels={
-                    "name": self.name,
                     "component": "binderhub-build",
                 },
-                annotations={
-                    "binder-repo": self.repo_url,
-                },
             ),
             spec=client.V1PodSpec(
                 containers=[
                     client.V1Container(
-                        image=self.builder_image,
+                        image=builder_image,
                         name="builder",
-                        args=self.get_cmd(),
-                        image_pull_policy='Always',
+                        image_pull_policy=image_pull_policy,
                         volume_mounts=volume_mounts,
                         resources=client.V1ResourceRequirements(
-                            limits={'memory': self.memory_limit},
-                            requests={'memory': self.memory_limit}
+                            limits={'memory': memory_limit},
+                            requests={'memory': memory_limit}
                         ),
-                        env=env
                     )
                 ],
-                node_selector=self.node_selector,
+                node_selector=node_selector,
                 volumes=volumes,
                 restart_policy="Never"
             )
         )
+        if not overrides:
+            return pod
+
+        api_client = client.ApiClient()
+        manifest = merge_pod_manifest(api_client.sanitize_for_serialization(pod), overrides)
+        # deserialize from a response-like object, which is how the client validates models
+        try:
+            pod = api_client.deserialize(SimpleNamespace(data=json.dumps(manifest)), 'V1Pod')
+        except ValueError as e:
+            raise ValueError("Invalid build pod template: %s" % e)
+        if not any(container.name == 'builder' for container in pod.spec.containers):
+            raise ValueError("Invalid build pod template: no container named 'builder'")
+        return pod
+
+    def make_pod(self):
+        """Make the pod for this build from the template
+
+        Only the parts that differ between builds are copied,
+        the rest is shared with the template.
+        """
+        template = self.pod_template
+        if template is None:
+            template = self.make_pod_template(
+                builder_image=self.builder_image,
+                push_secret=self.push_secret,
+                memory_limit=self.memory_limit,
+                docker_host=self.docker_host,
+                node_selector=self.node_selector,
+            )
+
+        env = []
+        if self.git_credentials:
+            env.append(client.V1EnvVar(name='GIT_CREDENTIAL_ENV', value=self.git_credentials))
+
+        containers = []
+        for container in template.spec.containers:
+            if container.name == 'builder':
+                container = copy.copy(container)
+                container.args = self.get_cmd()
+                container.env = (container.env or []) + env
+            containers.append(container)
+
+        pod = copy.copy(template)
+        pod.metadata = copy.copy(template.metadata)
+        pod.metadata.name = self.name
+        pod.metadata.labels = dict(template.metadata.labels or {}, **{
+            "name": self.name,
+            "component": "binderhub-build",
+        })
+        pod.metadata.annotations = dict(template.metadata.annotations or {}, **{
+            "binder-repo": self.repo_url,
+        })
+        pod.spec = copy.copy(template.spec)
+        pod.spec.containers = containers
+        if self.preferred_node:
+            pod.spec.affinity = self.prefer_node(template.spec.affinity, self.preferred_node)
+        return pod
+
+    @staticmethod
+    def prefer_node(affinity, node_name):
+        """Return a copy of `affinity` preferring to schedule on a node"""
+        affinity = copy.copy(affinity) or client.V1Affinity()
+        node_affinity = copy.copy(affinity.node_affinity) or client.V1NodeAffinity()
+        node_affinity.preferred_during_scheduling_ignored_during_execution = [
+            *(node_affinity.preferred_during_scheduling_ignored_during_execution or []),
+            client.V1PreferredSchedulingTerm(
+                weight=100,
+                preference=client.V1NodeSelectorTerm(
+                    match_fields=[client.V1NodeSelectorRequirement(
+                        key='metadata.name',
+                        operator='In',
+                        values=[node_name],
+                    )],
+                ),
+            ),
+        ]
+        affinity.node_affinity = node_affinity
+        return affinity
+
+    def submit(self):
+        """Submit a image spec to openshift's s2i and wait for completion """
+        self.pod = self.make_pod()
 
         try:
             ret = self.api.create_namespaced_pod(self.namespace, self.pod)
@@ -289,6 +359,141 @@ class Build:
         """Stop watching a build"""
         self.stop_event.set()
 
+class BuildCleaner(PodWatcher):
+    """Delete build pods when they stop, and when they run longer than `max_age`
+
+    Build pods are followed with a watch (see PodWatcher),
+    so stopped pods are deleted as soon as the event arrives
+    instead of at the next periodic check.
+    Running pods are kept in a heap by the time they expire,
+    with a single timer for the next one.
+    """
+
+    STOPPED_PHASES = {'Failed', 'Succeeded', 'Evicted'}
+
+    thread_name = 'build-cleaner-watch'
+    pods_description = 'build pods'
+
+    def __init__(self, kube, namespace, max_age, executor=None, resync_interval=300):
+        super().__init__(kube, namespace, 'component=binderhub-build', resync_interval)
+        self.max_age = max_age
+        self.executor = executor
+
+        # pod name -> expiry time of running pods
+        self._expiry = {}
+        # (expiry time, pod name), may include outdated entries
+        self._expiry_heap = []
+        self._timer = None
+        # pods being deleted
+        self._deleting = set()
+
+    def stop(self):
+        """Stop watching build pods"""
+        super().stop()
+        if self._timer is not None:
+            self.main_loop.remove_timeout(self._timer)
+            self._timer = None
+
+    def _pods_listed(self, pods):
+        self._reset(pods)
+
+    def _pod_changed(self, pod, deleted):
+        self._update(pod, deleted)
+
+    def _reset(self, pods):
+        """Replace the pods being tracked with the result of a full list"""
+        phases = defaultdict(int)
+        for pod in pods:
+            phases[pod.status.phase] += 1
+        app_log.debug("Build phase summary: %s", json.dumps(phases, sort_keys=True, indent=1))
+        self._expiry = {}
+        self._expiry_heap = []
+        # forget deletions of pods that are gone, in case their event was missed
+        self._deleting &= {pod.metadata.name for pod in pods}
+        for pod in pods:
+            self._update(pod)
+        self._schedule()
+
+    def _update(self, pod, deleted=False):
+        """Handle a change to a build pod"""
+        name = pod.metadata.name
+        if deleted or pod.metadata.deletion_timestamp:
+            self._expiry.pop(name, None)
+            if deleted:
+                self._deleting.discard(name)
+            return
+
+        if pod.status.phase in self.STOPPED_PHASES:
+            self._expiry.pop(name, None)
+            self._delete(pod, pod.status.phase)
+            return
+
+        started = pod.status.start_time or pod.metadata.creation_timestamp
+        if not self.max_age or not started or name in self._expiry:
+            return
+        expiry = started.timestamp() + self.max_age
+        self._expiry[name] = expiry
+        heapq.heappush(self._expiry_heap, (expiry, name))
+        if self._expiry_heap[0] == (expiry, name):
+            self._schedule()
+
+    def _schedule(self):
+        """Set the timer for the next pod to expire"""
+        if self._timer is not None:
+            self.main_loop.remove_timeout(self._timer)
+            self._timer = None
+        if self._expiry_heap:
+            delay = max(self._expiry_heap[0][0] - time.time(), 0)
+            self._timer = self.main_loop.call_later(delay, self._expire)
+
+    def _expire(self):
+        """Delete the pods that have run for longer than max_age"""
+        self._timer = None
+        now = time.time()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expiry, name = heapq.heappop(self._expiry_heap)
+            if self._expiry.get(name) != expiry:
+                # the pod stopped or was deleted since
+                continue
+            del self._expiry[name]
+            self._delete_pod(name, "long-running build %s" % name)
+        self._schedule()
+
+    def _delete(self, pod, phase):
+        annotations = pod.metadata.annotations or {}
+        repo = annotations.get("binder-repo", "unknown")
+        self._delete_pod(pod.metadata.name, "%s build %s (repo=%s)" % (phase, pod.metadata.name, repo))
+
+    def _delete_pod(self, name, description):
+        if name in self._deleting:
+            return
+        app_log.info("Deleting %s", description)
+        self._deleting.add(name)
+        f = self.main_loop.run_in_executor(self.executor, self._delete_in_thread, name)
+        self.main_loop.add_future(f, lambda f: self._deleted(name, f))
+
+    def _delete_in_thread(self, name):
+        try:
+            self.kube.delete_namespaced_pod(
+                name=name,
+                namespace=self.namespace,
+                body=client.V1DeleteOptions(grace_period_seconds=0))
+        except client.rest.ApiException as e:
+            if e.status == 404:
+                # Is ok, someone else has already deleted it
+                pass
+            else:
+                raise
+
+    def _deleted(self, name, f):
+        try:
+            f.result()
+        except Exception:
+            # allow trying again on the next event or resync
+            self._deleting.discard(name)
+            app_log.exception("Failed to delete build pod %s", name)
+
+
 class FakeBuild(Build):
     """
     Fake Building process to be able to work on the UI without a running Minikube.
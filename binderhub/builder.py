@@ -2,25 +2,32 @@
 Handlers for working with version control services (i.e. GitHub) for builds.
 """
 
+from collections import deque
+from functools import partial
 import hashlib
 from http.client import responses
 import json
 import string
 import time
+import uuid
+import zlib
 import escapism
 
 import docker
-from tornado.concurrent import chain_future, Future
 from tornado import gen
-from tornado.web import Finish, authenticated
+from tornado.web import Finish, OutputTransform, authenticated
 from tornado.queues import Queue
 from tornado.iostream import StreamClosedError
-from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import app_log
 from prometheus_client import Counter, Histogram, Gauge
 
 from .base import BaseHandler
 from .build import Build, FakeBuild
+from .launcher import LaunchState, observe_launch_stage
+from .quota import image_repo
+from .utils import Cache
 
 # Separate buckets for builds and launches.
 # Builds and launches have very different characteristic times,
@@ -51,6 +58,277 @@ LAUNCH_COUNT = Counter(
 )
 BUILDS_INPROGRESS = Gauge('binderhub_inprogress_builds', 'Builds currently in progress')
 LAUNCHES_INPROGRESS = Gauge('binderhub_inprogress_launches', 'Launches currently in progress')
+BUILD_NODE_TIME = Histogram(
+    'binderhub_build_node_affinity_time_seconds',
+    'Build times by whether the build ran on the node that built the repo before',
+    ['result'],
+    buckets=BUILD_BUCKETS,
+)
+BUILDS_CANCELLED = Counter(
+    'binderhub_cancelled_builds',
+    'Builds deleted because no one was watching them',
+)
+PARKED_CONNECTIONS = Gauge(
+    'binderhub_parked_connections',
+    'Finished event streams held open until the client closes them',
+)
+
+
+class EventStreamCompression(OutputTransform):
+    """Compress event streams with gzip or deflate, if the client accepts it
+
+    Unlike buffered responses, event streams are compressed with a sync flush
+    after every write, so each batch of events reaches the client
+    as soon as it is sent, while repetitive build logs still compress well.
+    Other responses are left alone.
+    """
+
+    # in order of preference
+    ENCODINGS = {
+        'gzip': 16 + zlib.MAX_WBITS,
+        'deflate': zlib.MAX_WBITS,
+    }
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, request):
+        accepted = set()
+        for value in request.headers.get('Accept-Encoding', '').split(','):
+            encoding, _, params = value.partition(';')
+            params = params.replace(' ', '')
+            if params.startswith('q=') and params[2:].strip('0.') == '':
+                # q=0 means not acceptable
+                continue
+            accepted.add(encoding.strip().lower())
+        self._encoding = next((e for e in self.ENCODINGS if e in accepted), None)
+        self._compressor = None
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        content_type = headers.get('Content-Type', '').split(';')[0].strip()
+        if content_type != 'text/event-stream' or 'Content-Encoding' in headers:
+            return status_code, headers, chunk
+        headers.add('Vary', 'Accept-Encoding')
+        if self._encoding:
+            headers['Content-Encoding'] = self._encoding
+            headers.pop('Content-Length', None)
+            self._compressor = zlib.compressobj(
+                self.COMPRESSION_LEVEL, zlib.DEFLATED, self.ENCODINGS[self._encoding])
+            chunk = self.transform_chunk(chunk, finishing)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is None:
+            return chunk
+        if not chunk and not finishing:
+            return chunk
+        data = self._compressor.compress(chunk)
+        return data + self._compressor.flush(zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
+class ConnectionParking:
+    """Hold connections open until their client closes them, or a timeout
+
+    Only the connection's stream is kept, not the request handler,
+    so everything else about the request can be released right away.
+    A single periodic callback closes connections that reach the timeout.
+    """
+
+    def __init__(self, timeout, check_interval=5):
+        self.timeout = timeout
+        self.check_interval = check_interval
+        # (deadline, stream) in order of deadline, since the timeout is fixed
+        self._parked = deque()
+        self._callback = None
+
+    def park(self, stream):
+        """Hold a stream open"""
+        deadline = IOLoop.current().time() + self.timeout
+        self._parked.append((deadline, stream))
+        PARKED_CONNECTIONS.inc()
+        stream.set_close_callback(PARKED_CONNECTIONS.dec)
+        # reading is how a closed connection is noticed
+        IOLoop.current().add_future(stream.read_until_close(), lambda f: f.exception())
+        if self._callback is None:
+            self._callback = PeriodicCallback(self._close_expired, self.check_interval * 1e3)
+            self._callback.start()
+
+    def _close_expired(self):
+        now = IOLoop.current().time()
+        while self._parked and self._parked[0][0] <= now:
+            deadline, stream = self._parked.popleft()
+            if not stream.closed():
+                stream.close()
+        if not self._parked:
+            self._callback.stop()
+            self._callback = None
+
+
+class BuildWatchers:
+    """Count the requests watching each build pod, deleting pods no one watches
+
+    Several requests can watch the same build pod.
+    When the last one finishes before the build does
+    (i.e. all clients have left and did not resume),
+    the pod is deleted after a grace period, unless someone watches it again
+    or the build is close to done.
+    """
+
+    # phases of builds that are almost done, and should finish
+    NEAR_COMPLETION_PHASES = {'pushing', 'built'}
+
+    def __init__(self):
+        # build name -> number of watchers
+        self._counts = {}
+        # build name -> timeout handle of the pending deletion
+        self._pending = {}
+
+    def watch(self, build):
+        """Record a request watching `build`"""
+        self._counts[build.name] = self._counts.get(build.name, 0) + 1
+        handle = self._pending.pop(build.name, None)
+        if handle is not None:
+            app_log.info("Build %s is watched again, not deleting it", build.name)
+            IOLoop.current().remove_timeout(handle)
+
+    def unwatch(self, build, grace_period, phase=None, finished=False):
+        """Record a request no longer watching `build`
+
+        If no one else is, the pod is deleted after `grace_period` seconds,
+        unless the build `finished` or is in a phase near completion.
+        A `grace_period` of 0 means never delete.
+        """
+        count = self._counts.get(build.name, 0) - 1
+        if count > 0:
+            self._counts[build.name] = count
+            return
+        self._counts.pop(build.name, None)
+        if finished or not grace_period:
+            return
+        if phase in self.NEAR_COMPLETION_PHASES:
+            app_log.info("No one is watching build %s, letting it finish (%s)", build.name, phase)
+            return
+        app_log.info("No one is watching build %s, deleting it in %is", build.name, grace_period)
+        self._pending[build.name] = IOLoop.current().call_later(
+            grace_period, self._delete, build,
+        )
+
+    def _delete(self, build):
+        self._pending.pop(build.name, None)
+        app_log.info("Deleting build %s, no one watched it for a while", build.name)
+        BUILDS_CANCELLED.inc()
+        f = IOLoop.current().run_in_executor(None, build.cleanup)
+        IOLoop.current().add_future(f, partial(self._deleted, build))
+
+    @staticmethod
+    def _deleted(build, f):
+        try:
+            f.result()
+        except Exception:
+            app_log.exception("Failed to delete build %s", build.name)
+
+
+class StreamStatus:
+    """The phase of an event stream, for status requests
+
+    Kept instead of the stream's events, which can be large.
+    """
+
+    def __init__(self):
+        self.phase = None
+        self.queue_position = None
+        self.finished = False
+        self._changed = Condition()
+
+    def update(self, event):
+        """Update the status from an event"""
+        self.phase = event.get('phase', self.phase)
+        self.queue_position = event.get('queue_position')
+
+    def finish(self):
+        """Mark the end of the stream"""
+        self.finished = True
+        self._changed.notify_all()
+
+    async def wait(self, timeout):
+        """Wait up to `timeout` seconds for the end of the stream"""
+        deadline = IOLoop.current().time() + timeout
+        while not self.finished and IOLoop.current().time() < deadline:
+            await self._changed.wait(timeout=deadline)
+
+
+class EventBuffer:
+    """The recent events sent on an event stream
+
+    Kept for a while, so that a client that loses its connection
+    can reconnect with the Last-Event-ID header and get the events it missed,
+    instead of starting over.
+
+    Only the last `max_events` events are kept, plus the first event
+    of each phase, so long build logs don't all stay in memory.
+    A client that missed more than that gets the phase changes
+    and the latest events.
+    """
+
+    def __init__(self, key, max_events=1000):
+        # the provider:spec of the stream
+        self.key = key
+        # (number, data) of the latest events
+        self.events = deque(maxlen=max_events)
+        # phase -> (number, data) of the first event in each phase
+        self.phase_events = {}
+        self.count = 0
+        self.finished = False
+        # clients following the stream after reconnecting
+        self.subscribers = 0
+        # the last time a client was connected
+        self.last_watched = IOLoop.current().time()
+        self.status = StreamStatus()
+        self._changed = Condition()
+
+    def append(self, data, event=None):
+        """Add a serialized event, returning its number
+
+        `event` is the unserialized event, if available,
+        used to keep track of the stream's phase.
+        """
+        self.count += 1
+        self.events.append((self.count, data))
+        if event:
+            self.status.update(event)
+            phase = event.get('phase')
+            if phase and phase not in self.phase_events:
+                self.phase_events[phase] = (self.count, data)
+        self._changed.notify_all()
+        return self.count
+
+    def finish(self):
+        """Mark the end of the stream"""
+        self.finished = True
+        self.status.finish()
+        self._changed.notify_all()
+
+    def events_after(self, last_seen):
+        """Return (number, data) of the events kept after number `last_seen`"""
+        latest = [(number, data) for number, data in self.events if number > last_seen]
+        first_latest = latest[0][0] if latest else self.count + 1
+        # phase changes that are no longer among the latest events
+        earlier = sorted(
+            (number, data) for number, data in self.phase_events.values()
+            if last_seen < number < first_latest
+        )
+        return earlier + latest
+
+    async def follow(self, last_seen):
+        """Yield (number, data) for events after number `last_seen`
+
+        until the end of the stream.
+        """
+        number = last_seen
+        while True:
+            for number, data in self.events_after(number):
+                yield number, data
+            if self.finished:
+                return
+            await self._changed.wait()
 
 
 class BuildHandler(BaseHandler):
@@ -58,46 +336,177 @@ class BuildHandler(BaseHandler):
 
     # emit keepalives every 25 seconds to avoid idle connections being closed
     KEEPALIVE_INTERVAL = 25
+    # finished event streams, held open for a while after the last event
+    parking = ConnectionParking(timeout=60)
+    # events of running streams, and streams that finished less than
+    # RESUME_TIMEOUT ago, by stream id, for clients resuming them.
+    # Not an LRU cache, so the buffers of running streams are never evicted,
+    # however many are open; finished ones are removed in on_finish.
+    event_buffers = {}
+    # the status of the latest stream for each provider:spec, for status requests
+    latest_streams = Cache(1024)
+    event_buffer = None
+    # the requests watching each build
+    watchers = BuildWatchers()
+    # whether this request is counted as watching its build
+    _watching_build = False
+    _build_finished = False
+    # how long (seconds) to keep going after a client disconnects,
+    # giving it a chance to reconnect and resume
+    RESUME_TIMEOUT = 30
+    _stream_closed = False
+    # open event streams, sent keepalives by a single periodic callback
+    _event_streams = set()
+    _keepalive_callback = None
+    # the prefix of the url this handler is served at, used to extract the spec
+    url_prefix = '/build/'
     build = None
+    # set when launching from stale state because a provider or the registry is unavailable
+    degraded = False
+
+    # shared cache of images recently found in the registry,
+    # used to keep launching them while the registry is unavailable
+    found_images = Cache(4096)
+    # the node that last built each repo, where its layers are cached
+    build_nodes = Cache(4096)
+    # images built by repo and environment hash, whose layers later builds can reuse
+    environment_images = Cache(4096)
+
+    def format_event(self, serialized_data, event=None):
+        """Format an event, recording it in the stream's event buffer"""
+        if self.event_buffer is None:
+            return 'data: {}\n\n'.format(serialized_data)
+        number = self.event_buffer.append(serialized_data, event)
+        return 'id: {}-{}\ndata: {}\n\n'.format(self.stream_id, number, serialized_data)
 
     async def emit(self, data):
         """Emit an eventstream event"""
         if type(data) is not str:
             serialized_data = json.dumps(data)
+            event = self.format_event(serialized_data, data)
         else:
             serialized_data = data
+            event = self.format_event(serialized_data)
+        if self._stream_closed:
+            self.check_resumed()
+            return
         try:
-            self.write('data: {}\n\n'.format(serialized_data))
+            self.write(event)
+            self._last_write = IOLoop.current().time()
             await self.flush()
         except StreamClosedError:
+            if self.event_buffer is None:
+                app_log.warning("Stream closed while handling %s", self.request.uri)
+                # raise Finish to halt the handler
+                raise Finish()
+            app_log.info("Stream closed while handling %s, waiting for the client to resume it",
+                self.request.uri)
+            self._stream_closed = True
+            self.event_buffer.last_watched = IOLoop.current().time()
+
+    def check_resumed(self):
+        """Halt the handler if its client hasn't resumed the stream in time"""
+        buffer = self.event_buffer
+        if buffer.subscribers:
+            return
+        if IOLoop.current().time() - buffer.last_watched > self.RESUME_TIMEOUT:
             app_log.warning("Stream closed while handling %s", self.request.uri)
             # raise Finish to halt the handler
             raise Finish()
 
+    async def resume(self, key, last_event_id):
+        """Resume an event stream from its event buffer
+
+        Sends the events after `last_event_id`, then follows the stream
+        until it ends.
+        Returns False if the stream can't be resumed.
+        """
+        stream_id, _, number = last_event_id.partition('-')
+        buffer = self.event_buffers.get(stream_id)
+        if buffer is None or buffer.key != key or not number.isdigit():
+            return False
+        app_log.info("Resuming event stream %s for %s after event %s", stream_id, key, number)
+        buffer.subscribers += 1
+        try:
+            async for number, data in buffer.follow(int(number)):
+                self.write('id: {}-{}\ndata: {}\n\n'.format(stream_id, number, data))
+                self._last_write = IOLoop.current().time()
+                await self.flush()
+        except StreamClosedError:
+            return True
+        finally:
+            buffer.subscribers -= 1
+            buffer.last_watched = IOLoop.current().time()
+        await self.park_connection()
+        return True
+
     def on_finish(self):
         """Stop keepalive when finish has been called"""
-        self._keepalive = False
+        BuildHandler._event_streams.discard(self)
+        if self.event_buffer is not None:
+            self.event_buffer.finish()
+            # clients can resume the stream for a while after it ends
+            IOLoop.current().call_later(
+                self.RESUME_TIMEOUT, self.event_buffers.pop, self.stream_id, None,
+            )
         if self.build:
             # if we have a build, tell it to stop watching
             self.build.stop()
-
-    async def keep_alive(self):
-        """Constantly emit keepalive events
-
-        So that intermediate proxies don't terminate an idle connection
+            if self._watching_build:
+                self._watching_build = False
+                self.watchers.unwatch(
+                    self.build,
+                    self.settings.get('build_cancel_timeout', 0),
+                    phase=self.event_buffer.status.phase if self.event_buffer is not None else None,
+                    finished=self._build_finished,
+                )
+
+    def on_connection_close(self):
+        BuildHandler._event_streams.discard(self)
+        super().on_connection_close()
+
+    def keep_alive(self):
+        """Send keepalive events to this event stream until it is closed
+
+        So that intermediate proxies don't terminate an idle connection.
+        Keepalives for all streams are sent by one periodic callback.
         """
-        self._keepalive = True
-        while True:
-            await gen.sleep(self.KEEPALIVE_INTERVAL)
-            if not self._keepalive:
-                return
-            try:
-                # lines that start with : are comments
-                # and should be ignored by event consumers
-                self.write(':keepalive\n\n')
-                await self.flush()
-            except StreamClosedError:
-                return
+        self._last_write = IOLoop.current().time()
+        BuildHandler._event_streams.add(self)
+        if BuildHandler._keepalive_callback is None:
+            # check a few times per interval,
+            # so no stream is idle for much longer than KEEPALIVE_INTERVAL
+            BuildHandler._keepalive_callback = PeriodicCallback(
+                BuildHandler._send_keepalives,
+                self.KEEPALIVE_INTERVAL * 1e3 / 5,
+            )
+            BuildHandler._keepalive_callback.start()
+
+    @staticmethod
+    def _send_keepalives():
+        """Send a keepalive to every stream that has been idle for KEEPALIVE_INTERVAL"""
+        now = IOLoop.current().time()
+        for handler in list(BuildHandler._event_streams):
+            if handler._finished:
+                BuildHandler._event_streams.discard(handler)
+                continue
+            if now - handler._last_write < handler.KEEPALIVE_INTERVAL:
+                continue
+            handler._last_write = now
+            # lines that start with : are comments
+            # and should be ignored by event consumers
+            handler.write(':keepalive\n\n')
+            IOLoop.current().add_future(handler.flush(), partial(BuildHandler._keepalive_sent, handler))
+        if not BuildHandler._event_streams:
+            BuildHandler._keepalive_callback.stop()
+            BuildHandler._keepalive_callback = None
+
+    @staticmethod
+    def _keepalive_sent(handler, f):
+        try:
+            f.result()
+        except StreamClosedError:
+            BuildHandler._event_streams.discard(handler)
 
     def send_error(self, status_code, **kwargs):
         """event stream cannot set an error code, so send an error event"""
@@ -109,12 +518,12 @@ class BuildHandler(BaseHandler):
             message = responses.get(status_code, 'Unknown HTTP Error')
 
         # this cannot be async
-        evt = json.dumps({
+        evt = {
             'phase': 'failed',
             'status_code': status_code,
             'message': message + '\n',
-        })
-        self.write('data: {}\n\n'.format(evt))
+        }
+        self.write(self.format_event(json.dumps(evt), evt))
         self.finish()
 
     def initialize(self):
@@ -180,6 +589,19 @@ class BuildHandler(BaseHandler):
             hash=build_slug_hash[:hash_length],
         ).lower()
 
+    def get_image_name(self, provider, ref):
+        """Return the name of the image for a repo at a resolved ref"""
+        image_prefix = self.settings['docker_image_prefix']
+
+        # Enforces max 255 characters before image
+        safe_build_slug = self._safe_build_slug(provider.get_build_slug(), limit=255 - len(image_prefix))
+
+        return '{prefix}{build_slug}:{ref}'.format(
+            prefix=image_prefix,
+            build_slug=safe_build_slug,
+            ref=ref
+        ).replace('_', '-').lower()
+
     async def fail(self, message):
         await self.emit({
             'phase': 'failed',
@@ -202,7 +624,7 @@ class BuildHandler(BaseHandler):
                 repo, ref, etc.)
 
         """
-        prefix = '/build/' + provider_prefix
+        prefix = self.url_prefix + provider_prefix
         spec = self.get_spec_from_request(prefix)
 
         # set up for sending event streams
@@ -217,11 +639,22 @@ class BuildHandler(BaseHandler):
             return
 
         # create a heartbeat
-        IOLoop.current().spawn_callback(self.keep_alive)
+        self.keep_alive()
 
         spec = spec.rstrip("/")
         key = '%s:%s' % (provider_prefix, spec)
 
+        # EventSource clients send the id of the last event they got when reconnecting
+        last_event_id = self.request.headers.get('Last-Event-ID')
+        if last_event_id and await self.resume(key, last_event_id):
+            return
+
+        # record events, so that this stream can be resumed
+        self.stream_id = uuid.uuid4().hex
+        self.event_buffer = EventBuffer(key)
+        self.event_buffers[self.stream_id] = self.event_buffer
+        self.latest_streams.set(key, self.event_buffer.status)
+
         # get a provider object that encapsulates the provider and the spec
         try:
             provider = self.get_provider(provider_prefix, spec=spec)
@@ -238,6 +671,7 @@ class BuildHandler(BaseHandler):
             return
 
         repo_url = self.repo_url = provider.get_repo_url()
+        self.repo_identity = provider.get_repo_identity()
 
         # labels to apply to build/launch metrics
         self.repo_metric_labels = {
@@ -248,51 +682,53 @@ class BuildHandler(BaseHandler):
         try:
             ref = await provider.get_resolved_ref()
         except Exception as e:
-            await self.fail("Error resolving ref for %s: %s" % (key, e))
-            return
+            ref = None
+            if self.settings['stale_if_error']:
+                ref = provider.get_last_resolved_ref()
+            if ref is None:
+                await self.fail("Error resolving ref for %s: %s" % (key, e))
+                return
+            app_log.warning("Error resolving ref for %s, using last known ref %s: %s", key, ref, e)
+            self.degraded = True
         if ref is None:
             await self.fail("Could not resolve ref for %s. Double check your URL." % key)
             return
 
         # generate a complete build name (for GitHub: `build-{user}-{repo}-{ref}`)
 
-        image_prefix = self.settings['docker_image_prefix']
-
-        # Enforces max 255 characters before image
-        safe_build_slug = self._safe_build_slug(provider.get_build_slug(), limit=255 - len(image_prefix))
-
         build_name = self._generate_build_name(provider.get_build_slug(), ref, prefix='build-')
 
-        image_name = self.image_name = '{prefix}{build_slug}:{ref}'.format(
-            prefix=image_prefix,
-            build_slug=safe_build_slug,
-            ref=ref
-        ).replace('_', '-').lower()
+        image_name = self.image_name = self.get_image_name(provider, ref)
 
-        if self.settings['use_registry']:
-            image_manifest = await self.registry.get_image_manifest(*'/'.join(image_name.split('/')[-2:]).split(':', 1))
-            image_found = bool(image_manifest)
-        else:
-            # Check if the image exists locally!
-            # Assume we're running in single-node mode or all binder pods are assigned to the same node!
-            docker_client = docker.from_env(version='auto')
-            try:
-                docker_client.images.get(image_name)
-            except docker.errors.ImageNotFound:
-                # image doesn't exist, so do a build!
-                image_found = False
-            else:
-                image_found = True
+        try:
+            image_found = await self.image_exists(image_name)
+        except Exception as e:
+            if not (self.settings['stale_if_error'] and image_name in self.found_images):
+                raise
+            app_log.warning("Error checking for image %s, assuming it still exists: %s", image_name, e)
+            image_found = True
+            self.degraded = True
+
+        if self.degraded and not image_found:
+            # don't try to build while the provider is unavailable
+            await self.fail("%s is currently unavailable and no image was found for %s. Try again soon."
+                % (provider.name, key))
+            return
 
         # Launch a notebook server if the image already is built
         kube = self.settings['kubernetes_client']
 
         if image_found:
-            await self.emit({
+            self.found_images.set(image_name, True)
+            event = {
                 'phase': 'built',
                 'imageName': image_name,
                 'message': 'Found built image, launching...\n'
-            })
+            }
+            if self.degraded:
+                event['degraded'] = True
+                event['message'] = 'Found previously built image (%s is unavailable), launching...\n' % provider.name
+            await self.emit(event)
             with LAUNCHES_INPROGRESS.track_inprogress():
                 await self.launch(kube)
             self.event_log.emit('binderhub.jupyter.org/launch', 1, {
@@ -302,6 +738,9 @@ class BuildHandler(BaseHandler):
             })
             return
 
+        if not await self.check_repo_size(provider):
+            return
+
         # Prepare to build
         q = Queue()
 
@@ -311,6 +750,14 @@ class BuildHandler(BaseHandler):
             push_secret = None
 
         BuildClass = FakeBuild if self.settings.get('fake_build') else Build
+        if self.settings.get('sticky_builds'):
+            preferred_node = self.build_nodes.get(repo_url)
+        else:
+            preferred_node = None
+        if self.settings.get('reuse_environment_images'):
+            environment_key, cache_from = await self.get_environment_image(provider)
+        else:
+            environment_key = cache_from = None
         binder_url = '{proto}://{host}{base_url}v2/{provider}/{spec}'.format(
             proto=self.request.protocol,
             host=self.request.host,
@@ -338,11 +785,16 @@ class BuildHandler(BaseHandler):
             node_selector=self.settings['build_node_selector'],
             appendix=appendix,
             log_tail_lines=self.settings['log_tail_lines'],
-            git_credentials=provider.git_credentials
+            git_credentials=provider.git_credentials,
+            pod_template=self.settings.get('build_pod_template'),
+            preferred_node=preferred_node,
+            cache_from=cache_from,
         )
 
         with BUILDS_INPROGRESS.track_inprogress():
             build_starttime = time.perf_counter()
+            self.watchers.watch(build)
+            self._watching_build = True
             pool = self.settings['build_pool']
             # Start building
             submit_future = pool.submit(build.submit)
@@ -352,9 +804,13 @@ class BuildHandler(BaseHandler):
             log_future = None
 
             # initial waiting event
+            if cache_from:
+                message = 'Waiting for build to start (environment unchanged, reusing its layers)...\n'
+            else:
+                message = 'Waiting for build to start...\n'
             await self.emit({
                 'phase': 'waiting',
-                'message': 'Waiting for build to start...\n',
+                'message': message,
             })
 
             done = False
@@ -388,21 +844,27 @@ class BuildHandler(BaseHandler):
                         event = {'phase': progress['payload']}
                 elif progress['kind'] == 'log':
                     # We expect logs to be already JSON structured anyway
-                    event = progress['payload']
-                    payload = json.loads(event)
+                    event = payload = json.loads(progress['payload'])
                     if payload.get('phase') == 'failure':
                         failed = True
                         BUILD_TIME.labels(status='failure').observe(time.perf_counter() - build_starttime)
                         BUILD_COUNT.labels(status='failure', **self.repo_metric_labels).inc()
 
                 await self.emit(event)
+            self._build_finished = True
 
         # Launch after building an image
         if not failed:
-            BUILD_TIME.labels(status='success').observe(time.perf_counter() - build_starttime)
+            self.found_images.set(image_name, True)
+            build_time = time.perf_counter() - build_starttime
+            BUILD_TIME.labels(status='success').observe(build_time)
+            if self.settings.get('sticky_builds'):
+                self.record_build_node(repo_url, preferred_node, build_time)
+            if environment_key:
+                self.environment_images.set(environment_key, image_name)
             BUILD_COUNT.labels(status='success', **self.repo_metric_labels).inc()
             with LAUNCHES_INPROGRESS.track_inprogress():
-                await self.launch(kube)
+                await self.launch(kube, just_built=True)
             self.event_log.emit('binderhub.jupyter.org/launch', 1, {
                 'provider': provider.name,
                 'spec': spec,
@@ -417,51 +879,169 @@ class BuildHandler(BaseHandler):
         # client will close its connection first.
         # The duration of this shouldn't matter because
         # well-behaved clients will close connections after they receive the launch event.
-        await gen.sleep(60)
+        if not self._finished and not self._stream_closed:
+            await self.park_connection()
 
-    async def launch(self, kube):
-        """Ask JupyterHub to launch the image."""
-        # check quota first
-        quota = self.settings.get('per_repo_quota')
-
-        # the image name (without tag) is unique per repo
-        # use this to count the number of pods running with a given repo
-        # if we added annotations/labels with the repo name via KubeSpawner
-        # we could do this better
-        image_no_tag = self.image_name.rsplit(':', 1)[0]
-        matching_pods = 0
-        total_pods = 0
-
-        # TODO: run a watch to keep this up to date in the background
-        pool = self.settings['executor']
-        f = pool.submit(kube.list_namespaced_pod,
-            self.settings["build_namespace"],
-            label_selector='app=jupyterhub,component=singleuser-server',
-        )
-        # concurrent.futures.Future isn't awaitable
-        # wrap in tornado Future
-        # tornado 5 will have `.run_in_executor`
-        tf = Future()
-        chain_future(f, tf)
-        pods = await tf
-        for pod in pods.items:
-            total_pods += 1
-            for container in pod.spec.containers:
-                # is the container running the same image as us?
-                # if so, count one for the current repo.
-                image = container.image.rsplit(':', 1)[0]
-                if image == image_no_tag:
-                    matching_pods += 1
-                    break
-
-        # TODO: allow whitelist of repos to exceed quota
-        # TODO: put busy users in a queue rather than fail?
-        # That would be hard to do without in-memory state.
-        if quota and matching_pods >= quota:
-            app_log.error("%s has exceeded quota: %s/%s (%s total)",
-                self.repo_url, matching_pods, quota, total_pods)
-            await self.fail("Too many users running %s! Try again soon." % self.repo_url)
+    async def park_connection(self):
+        """Keep the connection open without keeping this handler
+
+        The connection is closed when the client closes it,
+        or after ``parking.timeout`` seconds.
+        """
+        try:
+            await self.flush()
+        except StreamClosedError:
+            # already closed by the client
             return
+        self.application.log_request(self)
+        stream = self.detach()
+        # detaching finishes the request without calling on_finish
+        self.on_finish()
+        self.parking.park(stream)
+
+    async def get_environment_image(self, provider):
+        """Find an image of the repo built from the same environment files
+
+        Returns ``(key, image)``, where `key` identifies the repo's environment
+        at the resolved ref, to record the image about to be built,
+        and `image` is a previously built image with the same environment, or None.
+        Both are None if the provider can't hash the environment.
+        """
+        try:
+            environment_hash = await provider.get_environment_hash()
+        except Exception as e:
+            app_log.warning("Error getting environment hash of %s: %s", self.repo_url, e)
+            return None, None
+        if environment_hash is None:
+            return None, None
+        key = '{}@{}'.format(self.repo_identity, environment_hash)
+        image = self.environment_images.get(key)
+        if image:
+            app_log.info("Environment of %s unchanged since %s, reusing its layers", self.repo_url, image)
+        return key, image
+
+    def record_build_node(self, repo_url, preferred_node, build_time):
+        """Remember the node that built a repo, so the next build of it can prefer it
+
+        The build time is recorded by whether the build ran on the preferred node
+        ('hit'), another node ('miss') or had no preferred node ('new').
+        """
+        pod = getattr(self.build, 'pod', None)
+        node = pod.spec.node_name if pod is not None and pod.spec else None
+        if not node:
+            return
+        if preferred_node is None:
+            result = 'new'
+        elif node == preferred_node:
+            result = 'hit'
+        else:
+            result = 'miss'
+        BUILD_NODE_TIME.labels(result=result).observe(build_time)
+        self.build_nodes.set(repo_url, node)
+
+    async def check_repo_size(self, provider):
+        """Check that a repo is not too big to build
+
+        Sends a failure event and returns False if it is.
+        """
+        max_repo_size = self.settings['max_repo_size']
+        if not max_repo_size:
+            return True
+        try:
+            repo_size = await provider.get_repo_size()
+        except Exception as e:
+            # don't block builds if we can't find out
+            app_log.warning("Error getting size of %s: %s", self.repo_url, e)
+            return True
+        if repo_size is not None and repo_size > max_repo_size:
+            app_log.warning("Not building %s: size %s exceeds %s",
+                self.repo_url, repo_size, max_repo_size)
+            await self.fail("Repository %s is too big to build (%i MB, limit %i MB)."
+                % (self.repo_url, repo_size // (1024 * 1024), max_repo_size // (1024 * 1024)))
+            return False
+        return True
+
+    async def image_exists(self, image_name):
+        """Return whether an image has already been built"""
+        if self.settings['use_registry']:
+            image_manifest = await self.registry.get_image_manifest(*'/'.join(image_name.split('/')[-2:]).split(':', 1))
+            return bool(image_manifest)
+        # Check if the image exists locally!
+        # Assume we're running in single-node mode or all binder pods are assigned to the same node!
+        docker_client = docker.from_env(version='auto')
+        try:
+            docker_client.images.get(image_name)
+        except docker.errors.ImageNotFound:
+            # image doesn't exist, so do a build!
+            return False
+        else:
+            return True
+
+    async def emit_launch_progress(self, event):
+        """Forward a spawn progress or queue position event from the Launcher"""
+        launch_event = {
+            'phase': 'launching',
+            'message': event['message'] + '\n',
+        }
+        if 'queue_position' in event:
+            launch_event['queue_position'] = event['queue_position']
+        await self.emit(launch_event)
+
+    def count_repo_pods(self):
+        """Count the servers running this repo
+
+        Returns (matching_pods, total_pods)
+        """
+        launch_quota = self.settings['launch_quota']
+        return launch_quota.count(image_repo(self.image_name)), launch_quota.total
+
+    def get_repo_quota(self):
+        """Return the maximum number of servers for the repo being launched
+
+        0 means no quota.
+        """
+        quota_tiers = self.settings.get('quota_tiers')
+        if quota_tiers:
+            return quota_tiers.quota_for(self.repo_identity)
+        return self.settings.get('per_repo_quota')
+
+    async def emit_quota_position(self, position):
+        """Tell the client where it is in the queue for a repo over its quota"""
+        await self.emit({
+            'phase': 'launching',
+            'message': 'Too many users running %s, waiting for a server to stop (position %i in queue)...\n'
+                % (self.repo_url, position),
+            'queue_position': position,
+        })
+
+    async def launch(self, kube, just_built=False):
+        """Ask JupyterHub to launch the image.
+
+        `just_built` is whether the image was built for this launch,
+        used to label the launch stage metrics.
+        """
+        launch_starttime = stage_start = time.perf_counter()
+        # check quota first
+        quota = self.get_repo_quota()
+        launch_quota = self.settings['launch_quota']
+        repo = image_repo(self.image_name)
+        matching_pods, total_pods = self.count_repo_pods()
+
+        if quota:
+            if matching_pods >= quota:
+                app_log.warning("%s has exceeded quota: %s/%s (%s total)",
+                    self.repo_url, matching_pods, quota, total_pods)
+            admitted = await launch_quota.acquire(
+                repo, quota,
+                timeout=self.settings['per_repo_quota_max_wait'],
+                position_callback=self.emit_quota_position,
+            )
+            if not admitted:
+                app_log.error("%s has exceeded quota: %s/%s (%s total)",
+                    self.repo_url, launch_quota.count(repo), quota, launch_quota.total)
+                await self.fail("Too many users running %s! Try again soon." % self.repo_url)
+                return
+        observe_launch_stage('quota_check', stage_start, just_built)
 
         if quota and matching_pods >= 0.5 * quota:
             log = app_log.warning
@@ -475,29 +1055,54 @@ class BuildHandler(BaseHandler):
             'message': 'Launching server...\n',
         })
 
+        try:
+            server_info = await self.launch_server(just_built)
+        finally:
+            if quota:
+                launch_quota.release(repo)
+
+        event = {
+            'phase': 'ready',
+            'message': 'server running at %s\n' % server_info['url'],
+        }
+        event.update(server_info)
+        if self.degraded:
+            event['degraded'] = True
+        observe_launch_stage('total', launch_starttime, just_built)
+        await self.emit(event)
+
+    async def launch_server(self, just_built=False):
+        """Launch a server for the image, retrying failed launches
+
+        Returns the server info from the Launcher.
+        """
         launcher = self.settings['launcher']
-        retry_delay = launcher.retry_delay
-        for i in range(launcher.retries):
-            launch_starttime = time.perf_counter()
-            if self.settings['auth_enabled']:
-                # get logged in user's name
-                user_model = self.hub_auth.get_user(self)
-                username = user_model['name']
-                if self.settings['use_named_servers']:
-                    # user can launch multiple servers, so create a unique server name
-                    server_name = launcher.unique_name_from_repo(self.repo_url)
-                else:
-                    server_name = ''
+        if self.settings['auth_enabled']:
+            # get logged in user's name
+            user_model = self.hub_auth.get_user(self)
+            username = user_model['name']
+            if self.settings['use_named_servers']:
+                # user can launch multiple servers, so create a unique server name
+                server_name = launcher.unique_name_from_repo(self.repo_url)
             else:
-                # create a name for temporary user
-                username = launcher.unique_name_from_repo(self.repo_url)
                 server_name = ''
+        else:
+            # create a name for temporary user
+            username = launcher.unique_name_from_repo(self.repo_url)
+            server_name = ''
+        # retries resume from the last step completed, with the same user and server
+        state = LaunchState()
+        retry_delay = launcher.retry_delay
+        for i in range(launcher.retries):
+            attempt_starttime = time.perf_counter()
             try:
                 server_info = await launcher.launch(image=self.image_name, username=username,
-                                                    server_name=server_name, repo_url=self.repo_url)
+                                                    server_name=server_name, repo_url=self.repo_url,
+                                                    event_callback=self.emit_launch_progress,
+                                                    just_built=just_built, state=state)
                 LAUNCH_TIME.labels(
                     status='success', retries=i,
-                ).observe(time.perf_counter() - launch_starttime)
+                ).observe(time.perf_counter() - attempt_starttime)
                 LAUNCH_COUNT.labels(
                     status='success', **self.repo_metric_labels,
                 ).inc()
@@ -511,7 +1116,7 @@ class BuildHandler(BaseHandler):
                 # retry count is only interesting in success
                 LAUNCH_TIME.labels(
                     status=status, retries=-1,
-                ).observe(time.perf_counter() - launch_starttime)
+                ).observe(time.perf_counter() - attempt_starttime)
                 if status == 'failure':
                     # don't count retries per repo
                     LAUNCH_COUNT.labels(
@@ -528,16 +1133,12 @@ class BuildHandler(BaseHandler):
                     'phase': 'launching',
                     'message': 'Launch attempt {} failed, retrying...\n'.format(i + 1),
                 })
+                stage_start = time.perf_counter()
                 await gen.sleep(retry_delay)
+                observe_launch_stage('retry_wait', stage_start, just_built)
                 # exponential backoff for consecutive failures
                 retry_delay *= 2
                 continue
             else:
                 # success
-                break
-        event = {
-            'phase': 'ready',
-            'message': 'server running at %s\n' % server_info['url'],
-        }
-        event.update(server_info)
-        await self.emit(event)
+                return server_info
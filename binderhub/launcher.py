@@ -2,19 +2,29 @@
 Launch an image with a temporary user via JupyterHub
 """
 import base64
+from collections import defaultdict, deque
+from datetime import timedelta
 import json
 import random
 import re
 import string
 from urllib.parse import urlparse
+import time
 import uuid
 import os
 
+from prometheus_client import Gauge, Histogram
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import app_log
 from tornado import web, gen
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.locks import Condition, Semaphore
+from tornado.queues import Queue
 from traitlets.config import LoggingConfigurable
-from traitlets import Integer, Unicode, Bool
+from traitlets import Integer, Float, Unicode, Bool, Instance, default
+
+from .quota import image_repo
+from .utils import CircuitBreaker
 
 # pattern for checking if it's an ssh repo and not a URL
 # used only after verifying that `://` is not present
@@ -26,6 +36,193 @@ SUFFIX_CHARS = string.ascii_lowercase + string.digits
 # Set length of suffix. Number of combinations = SUFFIX_CHARS**SUFFIX_LENGTH = 36**8 ~= 2**41
 SUFFIX_LENGTH = 8
 
+USER_POOL_AVAILABLE = Gauge(
+    'binderhub_user_pool_available',
+    'Pre-created temporary users available for launches',
+)
+WARM_SERVERS_AVAILABLE = Gauge(
+    'binderhub_warm_servers_available',
+    'Running servers waiting to be handed out to launches of popular images',
+)
+SPAWNS_INPROGRESS = Gauge(
+    'binderhub_inprogress_spawns',
+    'Servers currently being started on the Hub',
+)
+SPAWNS_QUEUED = Gauge(
+    'binderhub_queued_spawns',
+    'Launches waiting for a free slot to start a server',
+)
+HUB_API_QUEUE_TIME = Histogram(
+    'binderhub_hub_api_queue_time_seconds',
+    'Time Hub API requests wait for a free connection',
+    ['endpoint'],
+    buckets=[0.01, 0.1, 0.5, 1, 5, 10, 30, float("inf")],
+)
+HUB_API_REQUEST_TIME = Histogram(
+    'binderhub_hub_api_request_time_seconds',
+    'Latency of Hub API requests',
+    ['method', 'endpoint', 'code'],
+    buckets=[0.05, 0.1, 0.5, 1, 2, 5, 10, 30, float("inf")],
+)
+LAUNCH_STAGE_TIME = Histogram(
+    'binderhub_launch_stage_time_seconds',
+    'Time spent in each stage of launching a server',
+    ['stage', 'just_built'],
+    buckets=[0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, float("inf")],
+)
+
+
+def observe_launch_stage(stage, start, just_built=False):
+    """Record the time since `start` spent in a stage of a launch
+
+    `just_built` is whether the image was built for this launch,
+    since launches of freshly built images also have to pull them.
+    """
+    LAUNCH_STAGE_TIME.labels(
+        stage=stage, just_built=str(bool(just_built)).lower(),
+    ).observe(time.perf_counter() - start)
+
+
+def hub_api_endpoint(url):
+    """Return a metrics label for a Hub API url, without user and server names
+
+    e.g. users/abc-123/servers/ -> users/{name}/servers/{server}
+    """
+    parts = url.split('?', 1)[0].split('/')
+    if parts[0] != 'users' or len(parts) < 2:
+        return parts[0]
+    label = ['users', '{name}']
+    for part in parts[2:]:
+        if part in ('server', 'servers', 'progress', 'tokens'):
+            label.append(part)
+        else:
+            label.append('{server}')
+    return '/'.join(label)
+
+
+class HubAPIClient(LoggingConfigurable):
+    """HTTP client for requests to the JupyterHub API
+
+    Limits the number of concurrent requests to the Hub,
+    queueing the rest, and stops sending requests
+    for a while if the Hub is failing.
+    Uses its own AsyncHTTPClient instance, so connections to the Hub
+    are reused (with pycurl) and don't compete with other requests.
+    """
+
+    max_concurrent_requests = Integer(
+        20,
+        config=True,
+        help="""
+        Maximum number of concurrent requests to the Hub API.
+
+        Further requests wait in a queue.
+        """
+    )
+    queue_timeout = Float(
+        30,
+        config=True,
+        help="""
+        Time (seconds) a request waits in the queue before failing.
+
+        0 means wait forever.
+        """
+    )
+    circuit_breaker_threshold = Integer(
+        5,
+        config=True,
+        help="""
+        Number of consecutive failed requests before requests stop being sent
+        to the Hub for circuit_breaker_timeout seconds.
+        """
+    )
+    circuit_breaker_timeout = Integer(
+        30,
+        config=True,
+        help="""
+        Time (seconds) to stop sending requests to the Hub
+        after circuit_breaker_threshold consecutive failures.
+        """
+    )
+
+    http_client = Instance(AsyncHTTPClient)
+
+    @default('http_client')
+    def _default_http_client(self):
+        return AsyncHTTPClient(force_instance=True, max_clients=self.max_concurrent_requests)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._semaphore = Semaphore(self.max_concurrent_requests)
+        self.circuit_breaker = CircuitBreaker(
+            'JupyterHub',
+            failure_threshold=self.circuit_breaker_threshold,
+            reset_timeout=self.circuit_breaker_timeout,
+        )
+
+    async def fetch(self, req, endpoint='unknown'):
+        """Fetch a request to the Hub API
+
+        ``endpoint`` is used to label metrics.
+        """
+        self.circuit_breaker.check()
+        queued = time.perf_counter()
+        try:
+            await self._semaphore.acquire(timeout=timedelta(seconds=self.queue_timeout))
+        except gen.TimeoutError:
+            HUB_API_QUEUE_TIME.labels(endpoint).observe(time.perf_counter() - queued)
+            app_log.error("Timeout waiting to send Hub API request to %s", endpoint)
+            raise web.HTTPError(503, "The Hub is busy. Try again soon.")
+        start = time.perf_counter()
+        HUB_API_QUEUE_TIME.labels(endpoint).observe(start - queued)
+        code = 599
+        try:
+            resp = await self.http_client.fetch(req)
+            code = resp.code
+            self.circuit_breaker.record_success()
+            return resp
+        except HTTPError as e:
+            code = e.code
+            if e.code >= 500:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+            raise
+        except Exception:
+            self.circuit_breaker.record_failure()
+            raise
+        finally:
+            self._semaphore.release()
+            HUB_API_REQUEST_TIME.labels(req.method, endpoint, code).observe(time.perf_counter() - start)
+
+
+class LaunchState:
+    """The steps completed by a launch
+
+    Passed to every attempt of a launch,
+    so that retries continue where the last attempt stopped
+    instead of creating another user and server on the Hub.
+    """
+
+    # steps, in order
+    NEW = 'new'
+    USER_CREATED = 'user created'
+    SPAWN_REQUESTED = 'spawn requested'
+    READY = 'ready'
+
+    def __init__(self):
+        self.step = self.NEW
+        self.username = None
+        self.server_name = ''
+        # the user_options of the server, including its token
+        self.data = None
+
+    def advance(self, step, **kwargs):
+        """Record that a step has been completed"""
+        self.step = step
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
 
 class Launcher(LoggingConfigurable):
     """Object for encapsulating launching an image for a user"""
@@ -52,17 +249,179 @@ class Launcher(LoggingConfigurable):
         """
     )
 
-    async def api_request(self, url, *args, **kwargs):
-        """Make an API request to JupyterHub"""
+    max_pending_spawns = Integer(
+        100,
+        config=True,
+        help="""
+        Maximum number of servers being started on the Hub at the same time.
+
+        Further launches wait in a queue, and are told their position in it,
+        until another server has finished starting,
+        instead of being rejected by the Hub with 429 errors.
+        Should not be higher than JupyterHub's `concurrent_spawn_limit`.
+
+        0 disables the limit.
+        """
+    )
+
+    use_progress_stream = Bool(
+        True,
+        config=True,
+        help="""
+        Follow the Hub's spawn progress event stream while a server is starting.
+
+        Progress messages are forwarded to the client
+        and launches complete as soon as the server is ready.
+        If the stream is unavailable (JupyterHub < 0.9),
+        the Hub is polled for the server's status instead.
+        """
+    )
+    launch_timeout = Integer(
+        600,
+        config=True,
+        help="""
+        Time (seconds) to wait for a server to become ready
+        while following the Hub's progress event stream.
+        """
+    )
+
+    user_pool_size = Integer(
+        0,
+        config=True,
+        help="""
+        Number of temporary users to create ahead of launches.
+
+        Launches use a pre-created user instead of creating one,
+        removing a Hub API request from each launch.
+        The pool is refilled in the background.
+        Only used when authentication is not enabled.
+
+        0 (default) disables the pool.
+        """
+    )
+    user_pool_prefix = Unicode(
+        'binder',
+        config=True,
+        help="""
+        Prefix for the names of pre-created temporary users.
+
+        Pooled users are created before the repo is known,
+        so their names cannot include the repo.
+        """
+    )
+    user_pool_max_age = Integer(
+        600,
+        config=True,
+        help="""
+        Time (seconds) after which unused pre-created users are discarded.
+
+        Should be shorter than the Hub's culling timeout for inactive users,
+        so that pooled users are not deleted before they are used.
+        """
+    )
+
+    warm_pool_size = Integer(
+        0,
+        config=True,
+        help="""
+        Number of running, unclaimed servers to keep for each popular image.
+
+        Launches of a popular image are handed one of these servers
+        instead of waiting for a new server to start.
+        Only used when authentication is not enabled.
+        Unclaimed warm servers don't count towards the image's per-repo quota.
+
+        0 (default) disables warm pools.
+        """
+    )
+    warm_pool_min_launches = Integer(
+        10,
+        config=True,
+        help="""
+        Minimum number of launches of an image within warm_pool_window
+        for the image to get a warm pool.
+        """
+    )
+    warm_pool_window = Integer(
+        3600,
+        config=True,
+        help="""
+        Time (seconds) over which launches are counted to pick popular images.
+        """
+    )
+    warm_pool_max_images = Integer(
+        10,
+        config=True,
+        help="""
+        Maximum number of images (the most launched ones) with warm pools.
+        """
+    )
+    warm_pool_max_age = Integer(
+        600,
+        config=True,
+        help="""
+        Time (seconds) after which unclaimed warm servers are stopped.
+
+        Should be shorter than the Hub's idle culling timeout,
+        so that warm servers are not culled before they are claimed.
+        """
+    )
+    warm_pool_reap_interval = Integer(
+        60,
+        config=True,
+        help="""
+        Interval (seconds) at which expired warm servers,
+        and warm servers of images that are no longer popular, are stopped.
+        """
+    )
+
+    hub_client = Instance(HubAPIClient)
+
+    @default('hub_client')
+    def _default_hub_client(self):
+        return HubAPIClient(parent=self)
+
+    progress_client = Instance(AsyncHTTPClient)
+
+    @default('progress_client')
+    def _default_progress_client(self):
+        # one long-lived progress stream per pending spawn,
+        # kept off the shared client used for provider and registry requests
+        return AsyncHTTPClient(force_instance=True, max_clients=self.max_pending_spawns or 100)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # pre-created users, as (username, created) tuples
+        self._user_pool = deque()
+        self._filling_user_pool = False
+        # recent launch times and repo for each image
+        self._launch_times = defaultdict(deque)
+        self._image_repos = {}
+        # running, unclaimed servers for each image, as (server_info, created) tuples
+        self._warm_servers = defaultdict(deque)
+        self._warming = set()
+        self._warm_pool_reaper = None
+        # launches waiting to start a server, and servers being started
+        self._spawn_queue = deque()
+        self._pending_spawns = 0
+        self._spawn_slot_freed = Condition()
+
+    def _hub_request(self, url, *args, **kwargs):
+        """Create an authenticated HTTPRequest for the JupyterHub API"""
         headers = kwargs.setdefault('headers', {})
         headers.update({'Authorization': 'token %s' % self.hub_api_token})
         hub_api_url = os.getenv('JUPYTERHUB_API_URL', '') or self.hub_url + 'hub/api/'
-        request_url = hub_api_url + url
-        req = HTTPRequest(request_url, *args, **kwargs)
+        return HTTPRequest(hub_api_url + url, *args, **kwargs)
+
+    async def api_request(self, url, *args, **kwargs):
+        """Make an API request to JupyterHub"""
+        req = self._hub_request(url, *args, **kwargs)
+        request_url = req.url
+        endpoint = hub_api_endpoint(url)
         retry_delay = self.retry_delay
         for i in range(1, self.retries + 1):
             try:
-                return await AsyncHTTPClient().fetch(req)
+                return await self.hub_client.fetch(req, endpoint)
             except HTTPError as e:
                 # swallow 409 errors on retry only (not first attempt)
                 if i > 1 and e.code == 409 and e.response:
@@ -80,6 +439,16 @@ class Launcher(LoggingConfigurable):
                     await gen.sleep(retry_delay)
                     # exponential backoff for consecutive failures
                     retry_delay *= 2
+                elif e.code == 429 and i < self.retries:
+                    # the Hub is starting too many servers,
+                    # e.g. ones not launched by this BinderHub.
+                    # Wait as long as it asks us to.
+                    try:
+                        delay = int(e.response.headers['Retry-After'])
+                    except (AttributeError, KeyError, ValueError):
+                        delay = retry_delay
+                    self.log.warning("Hub is busy (using %s), retrying in %ss", request_url, delay)
+                    await gen.sleep(delay)
                 else:
                     raise
 
@@ -91,6 +460,264 @@ class Launcher(LoggingConfigurable):
         body = json.loads(resp.body.decode('utf-8'))
         return body
 
+    async def wait_for_progress(self, username, server_name='', event_callback=None):
+        """Follow the Hub's progress event stream for a spawning server
+
+        Each progress event with a message is passed to ``event_callback``.
+        Returns True if the server became ready, False if the spawn failed.
+        Raises if the stream is not available or ends early,
+        in which case the caller should fall back to polling.
+        """
+        if server_name:
+            url = 'users/{}/servers/{}/progress'.format(username, server_name)
+        else:
+            url = 'users/{}/server/progress'.format(username)
+
+        events = Queue()
+        buffer = [b'']
+
+        def streaming_callback(chunk):
+            """Parse event-stream chunks into events"""
+            *messages, buffer[0] = (buffer[0] + chunk).replace(b'\r\n', b'\n').split(b'\n\n')
+            for message in messages:
+                for line in message.splitlines():
+                    if line.startswith(b'data:'):
+                        events.put_nowait(json.loads(line[5:].decode('utf8')))
+
+        req = self._hub_request(
+            url,
+            method='GET',
+            headers={'Accept': 'text/event-stream'},
+            request_timeout=self.launch_timeout,
+            streaming_callback=streaming_callback,
+        )
+        # long-lived, so not sent through hub_client,
+        # where it would hold one of the limited connections
+        fetch = gen.convert_yielded(self.progress_client.fetch(req))
+
+        def stream_done(f):
+            # retrieve the exception, so it isn't logged if we've stopped waiting
+            f.exception()
+            # signal the end of the stream
+            events.put_nowait(None)
+
+        fetch.add_done_callback(stream_done)
+
+        while True:
+            event = await events.get()
+            if event is None:
+                # raise if the request failed
+                fetch.result()
+                raise ValueError("Progress stream for %s ended before server was ready" % username)
+            if event.get('ready'):
+                return True
+            if event.get('failed'):
+                return False
+            if event_callback and event.get('message'):
+                await event_callback(event)
+
+    async def create_hub_user(self, username):
+        """Create a temporary user on the Hub"""
+        await self.api_request('users/%s' % username, body=b'', method='POST')
+
+    async def fill_user_pool(self):
+        """Create temporary users until the pool is full
+
+        Only one fill runs at a time.
+        Errors stop filling until the next time a user is claimed.
+        """
+        if self._filling_user_pool or not self.create_user:
+            return
+        self._filling_user_pool = True
+        try:
+            while len(self._user_pool) < self.user_pool_size:
+                username = self.unique_name_from_repo(self.user_pool_prefix)
+                try:
+                    await self.create_hub_user(username)
+                except Exception as e:
+                    app_log.error("Error creating pooled user %s: %s", username, e)
+                    return
+                self._user_pool.append((username, time.monotonic()))
+                USER_POOL_AVAILABLE.set(len(self._user_pool))
+        finally:
+            self._filling_user_pool = False
+
+    def claim_pooled_user(self):
+        """Take a pre-created user from the pool
+
+        Returns None if the pool is empty.
+        Triggers refilling the pool in the background.
+        """
+        if not self.user_pool_size:
+            return None
+        username = None
+        now = time.monotonic()
+        while self._user_pool:
+            name, created = self._user_pool.popleft()
+            if now - created < self.user_pool_max_age:
+                username = name
+                break
+            app_log.debug("Deleting expired pooled user %s", name)
+            IOLoop.current().spawn_callback(self.delete_hub_user, name)
+        USER_POOL_AVAILABLE.set(len(self._user_pool))
+        IOLoop.current().spawn_callback(self.fill_user_pool)
+        return username
+
+    def record_launch(self, image, repo_url):
+        """Count a launch of an image, to find popular images"""
+        now = time.monotonic()
+        launch_times = self._launch_times[image]
+        launch_times.append(now)
+        while launch_times and now - launch_times[0] > self.warm_pool_window:
+            launch_times.popleft()
+        self._image_repos[image] = repo_url
+
+    def popular_images(self):
+        """Return the set of images that should have warm pools"""
+        now = time.monotonic()
+        counts = {}
+        for image, launch_times in list(self._launch_times.items()):
+            while launch_times and now - launch_times[0] > self.warm_pool_window:
+                launch_times.popleft()
+            if not launch_times:
+                self._launch_times.pop(image)
+                self._image_repos.pop(image, None)
+            elif len(launch_times) >= self.warm_pool_min_launches:
+                counts[image] = len(launch_times)
+        top = sorted(counts, key=counts.get, reverse=True)[:self.warm_pool_max_images]
+        return set(top)
+
+    def unclaimed_warm_servers(self, repo):
+        """The number of unclaimed warm servers of `repo` (an image without its tag)
+
+        These don't count towards the repo's quota, so they don't make
+        launches of the repo wait, and claiming one takes up a slot.
+        """
+        return sum(len(pool) for image, pool in self._warm_servers.items() if image_repo(image) == repo)
+
+    def _update_warm_servers_metric(self):
+        WARM_SERVERS_AVAILABLE.set(sum(len(pool) for pool in self._warm_servers.values()))
+
+    async def delete_hub_user(self, username):
+        """Delete a temporary user, stopping their server"""
+        try:
+            await self.api_request('users/%s' % username, method='DELETE')
+        except HTTPError as e:
+            app_log.error("Error deleting user %s: %s", username, e)
+
+    async def fill_warm_pool(self, image):
+        """Start servers for a popular image until its warm pool is full"""
+        if image in self._warming or not self.create_user:
+            return
+        self._warming.add(image)
+        try:
+            pool = self._warm_servers[image]
+            while image in self.popular_images() and len(pool) < self.warm_pool_size:
+                repo_url = self._image_repos[image]
+                username = self.unique_name_from_repo(repo_url)
+                try:
+                    server_info = await self.launch(
+                        image, username, repo_url=repo_url, use_warm_pool=False,
+                    )
+                except Exception as e:
+                    app_log.error("Error starting warm server for %s: %s", image, e)
+                    return
+                app_log.info("Started warm server for %s: %s", image, username)
+                server_info['username'] = username
+                pool.append((server_info, time.monotonic()))
+                self._update_warm_servers_metric()
+                if self._warm_pool_reaper is None:
+                    self._warm_pool_reaper = PeriodicCallback(
+                        self.reap_warm_servers, self.warm_pool_reap_interval * 1e3
+                    )
+                    self._warm_pool_reaper.start()
+        finally:
+            self._warming.discard(image)
+
+    def claim_warm_server(self, image):
+        """Take a running server for an image from its warm pool
+
+        Returns the server's info (as returned by launch),
+        or None if there is no warm server for the image.
+        Triggers refilling the pool in the background.
+        """
+        if not self.warm_pool_size:
+            return None
+        server_info = None
+        now = time.monotonic()
+        pool = self._warm_servers.get(image, ())
+        while pool:
+            info, created = pool.popleft()
+            if now - created < self.warm_pool_max_age:
+                server_info = info
+                break
+            app_log.info("Stopping expired warm server %s", info['username'])
+            IOLoop.current().spawn_callback(self.delete_hub_user, info['username'])
+        self._update_warm_servers_metric()
+        IOLoop.current().spawn_callback(self.fill_warm_pool, image)
+        return server_info
+
+    def reap_warm_servers(self):
+        """Stop warm servers that expired or whose image is no longer popular"""
+        popular = self.popular_images()
+        now = time.monotonic()
+        for image, pool in list(self._warm_servers.items()):
+            keep = []
+            for info, created in pool:
+                if image in popular and now - created < self.warm_pool_max_age:
+                    keep.append((info, created))
+                    continue
+                app_log.info("Stopping unclaimed warm server %s for %s", info['username'], image)
+                IOLoop.current().spawn_callback(self.delete_hub_user, info['username'])
+            # modified in place, the pool may be being filled
+            pool.clear()
+            pool.extend(keep)
+            if not pool and image not in self._warming:
+                del self._warm_servers[image]
+        self._update_warm_servers_metric()
+        if not self._warm_servers and self._warm_pool_reaper is not None:
+            self._warm_pool_reaper.stop()
+            self._warm_pool_reaper = None
+
+    async def acquire_spawn_slot(self, event_callback=None):
+        """Wait until a server can be started without exceeding max_pending_spawns
+
+        Launches are admitted in the order they arrive.
+        While waiting, the launch's position in the queue is sent to
+        ``event_callback``, if given, whenever it changes.
+        Every call must be followed by a call to :meth:`release_spawn_slot`.
+        """
+        if self.max_pending_spawns:
+            ticket = object()
+            self._spawn_queue.append(ticket)
+            SPAWNS_QUEUED.set(len(self._spawn_queue))
+            try:
+                reported_position = None
+                while True:
+                    position = self._spawn_queue.index(ticket) + 1
+                    if position == 1 and self._pending_spawns < self.max_pending_spawns:
+                        break
+                    if event_callback and position != reported_position:
+                        reported_position = position
+                        await event_callback({
+                            'message': 'Waiting for other servers to start (position %i in queue)...' % position,
+                            'queue_position': position,
+                        })
+                    await self._spawn_slot_freed.wait()
+            finally:
+                self._spawn_queue.remove(ticket)
+                SPAWNS_QUEUED.set(len(self._spawn_queue))
+                # the launches behind this one have moved up
+                self._spawn_slot_freed.notify_all()
+        self._pending_spawns += 1
+        SPAWNS_INPROGRESS.set(self._pending_spawns)
+
+    def release_spawn_slot(self):
+        """Record that a server has finished starting (or failed to)"""
+        self._pending_spawns -= 1
+        SPAWNS_INPROGRESS.set(self._pending_spawns)
+        self._spawn_slot_freed.notify_all()
+
     def unique_name_from_repo(self, repo_url):
         """Generate a unique name for a git repo url
 
@@ -117,67 +744,146 @@ class Launcher(LoggingConfigurable):
         # add a random suffix to avoid collisions for users on the same image
         return '{}-{}'.format(prefix, ''.join(random.choices(SUFFIX_CHARS, k=SUFFIX_LENGTH)))
 
-    async def launch(self, image, username, server_name='', repo_url=''):
+    async def launch(self, image, username, server_name='', repo_url='', event_callback=None,
+                     use_warm_pool=True, just_built=False, state=None):
         """Launch a server for a given image
 
+        - hands out a server from the image's warm pool, if there is one
         - creates a temporary user on the Hub if authentication is not enabled
         - spawns a server for temporary/authenticated user
+        - forwards spawn progress events to ``event_callback``, if given
         - generates a token
+        - records the time spent in each stage, labeled with `just_built`
         - returns a dict containing:
           - `url`: the URL of the server
           - `image`: image spec
           - `repo_url`: the url of the repo
           - `token`: the token for the server
+
+        If a :class:`LaunchState` is given, it records each completed step,
+        and passing the same state to a retry resumes the launch from there,
+        with the same user, server and token.
         """
         # TODO: validate the image argument?
+        if state is None:
+            state = LaunchState()
+        if state.username is not None:
+            # retrying, use the same user and server
+            app_log.info("Resuming launch of %s for user %s after step '%s'", image, state.username, state.step)
+            username = state.username
+            server_name = state.server_name
+        elif self.create_user and use_warm_pool and self.warm_pool_size:
+            self.record_launch(image, repo_url)
+            server_info = self.claim_warm_server(image)
+            if server_info:
+                app_log.info("Using warm server %s for image %s", server_info['username'], image)
+                server_info.pop('username')
+                return server_info
 
-        if self.create_user:
-            # create a new user
-            app_log.info("Creating user %s for image %s", username, image)
-            try:
-                await self.api_request('users/%s' % username, body=b'', method='POST')
-            except HTTPError as e:
-                if e.response:
-                    body = e.response.body
-                else:
-                    body = ''
-                app_log.error("Error creating user %s: %s\n%s",
-                    username, e, body,
-                )
-                raise web.HTTPError(500, "Failed to create temporary user for %s" % image)
-        elif server_name == '':
-            # authentication is enabled but not named servers
-            # check if user has a running server ('')
-            user_data = await self.get_user_data(username)
-            if server_name in user_data['servers']:
-                raise web.HTTPError(409, "User %s already has a running server." % username)
-
-        # data to be passed into spawner's user_options during launch
-        # and also to be returned into 'ready' state
-        data = {'image': image,
+        if state.step == LaunchState.NEW:
+            if self.create_user and state.username is None:
+                pooled_user = self.claim_pooled_user()
+            else:
+                pooled_user = None
+            if pooled_user:
+                app_log.info("Using pre-created user %s for image %s", pooled_user, image)
+                username = pooled_user
+            elif self.create_user:
+                # create a new user
+                app_log.info("Creating user %s for image %s", username, image)
+                stage_start = time.perf_counter()
+                try:
+                    await self.create_hub_user(username)
+                except HTTPError as e:
+                    # temporary user names have a random suffix,
+                    # so if the user exists, an earlier attempt created it
+                    # but didn't get the response
+                    if e.code != 409:
+                        if e.response:
+                            body = e.response.body
+                        else:
+                            body = ''
+                        app_log.error("Error creating user %s: %s\n%s",
+                            username, e, body,
+                        )
+                        # retry with the same name
+                        state.advance(LaunchState.NEW, username=username)
+                        raise web.HTTPError(500, "Failed to create temporary user for %s" % image)
+                observe_launch_stage('user_create', stage_start, just_built)
+            elif server_name == '':
+                # authentication is enabled but not named servers
+                # check if user has a running server ('')
+                user_data = await self.get_user_data(username)
+                if server_name in user_data['servers']:
+                    raise web.HTTPError(409, "User %s already has a running server." % username)
+            state.advance(LaunchState.USER_CREATED, username=username, server_name=server_name)
+
+        if state.data is None:
+            # data to be passed into spawner's user_options during launch
+            # and also to be returned into 'ready' state
+            state.data = {
+                'image': image,
                 'repo_url': repo_url,
-                'token': base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('ascii').rstrip('=\n')}
+                'token': base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('ascii').rstrip('=\n'),
+            }
+        data = dict(state.data)
 
         # server name to be used in logs
         _server_name = " {}".format(server_name) if server_name else ''
 
-        # start server
-        app_log.info("Starting server%s for user %s with image %s", _server_name, username, image)
+        # wait for the Hub to be able to start another server
+        stage_start = time.perf_counter()
+        await self.acquire_spawn_slot(event_callback)
+        observe_launch_stage('spawn_queue', stage_start, just_built)
+
         try:
-            resp = await self.api_request(
-                'users/{}/servers/{}'.format(username, server_name),
-                method='POST',
-                body=json.dumps(data).encode('utf8'),
-            )
-            if resp.code == 202:
+            if state.step == LaunchState.USER_CREATED:
+                # start server
+                app_log.info("Starting server%s for user %s with image %s", _server_name, username, image)
+                stage_start = time.perf_counter()
+                resp = await self.api_request(
+                    'users/{}/servers/{}'.format(username, server_name),
+                    method='POST',
+                    body=json.dumps(data).encode('utf8'),
+                )
+                observe_launch_stage('spawn_request', stage_start, just_built)
+                state.advance(LaunchState.SPAWN_REQUESTED)
+                pending = resp.code == 202
+            else:
+                # the server was requested by an earlier attempt,
+                # wait for it again
+                pending = True
+
+            stage_start = time.perf_counter()
+            ready = None
+            if pending and self.use_progress_stream:
+                # Server hasn't actually started yet,
+                # follow its progress until it is ready
+                try:
+                    ready = await self.wait_for_progress(username, server_name, event_callback)
+                except web.Finish:
+                    # the client has gone away
+                    raise
+                except Exception as e:
+                    app_log.warning("Failed to follow progress of server%s for user %s, polling instead: %s",
+                        _server_name, username, e)
+                else:
+                    if not ready:
+                        # the spawn failed, request a new one on retry
+                        state.advance(LaunchState.USER_CREATED)
+                        raise web.HTTPError(500, "Image %s for user %s failed to launch" % (image, username))
+            if pending and ready is None:
                 # Server hasn't actually started yet
                 # We wait for it!
                 # NOTE: This ends up being about ten minutes
                 for i in range(64):
                     user_data = await self.get_user_data(username)
-                    if user_data['servers'][server_name]['ready']:
+                    server = user_data['servers'].get(server_name)
+                    if server and server['ready']:
                         break
-                    if not user_data['servers'][server_name]['pending']:
+                    if not server or not server['pending']:
+                        # the spawn failed, request a new one on retry
+                        state.advance(LaunchState.USER_CREATED)
                         raise web.HTTPError(500, "Image %s for user %s failed to launch" % (image, username))
                     # FIXME: make this configurable
                     # FIXME: Measure how long it takes for servers to start
@@ -185,6 +891,8 @@ class Launcher(LoggingConfigurable):
                     await gen.sleep(min(1.4 ** i, 10))
                 else:
                     raise web.HTTPError(500, "Image %s for user %s took too long to launch" % (image, username))
+            if pending:
+                observe_launch_stage('spawn_wait', stage_start, just_built)
 
         except HTTPError as e:
             if e.response:
@@ -195,6 +903,57 @@ class Launcher(LoggingConfigurable):
             app_log.error("Error starting server{} for user {}: {}\n{}".
                           format(_server_name, username, e, body))
             raise web.HTTPError(500, "Failed to launch image %s" % image)
+        finally:
+            self.release_spawn_slot()
 
+        state.advance(LaunchState.READY)
         data['url'] = self.hub_url + 'user/%s/%s' % (username, server_name)
         return data
+
+    async def launch_batch(self, image, count, repo_url='', concurrency=10,
+                           progress_callback=None, just_built=False):
+        """Launch `count` servers of one image for temporary users
+
+        At most `concurrency` servers are launched at a time,
+        each retried like a single launch, resuming where it failed.
+        After each server is launched or has failed,
+        ``progress_callback(launched, failed)`` is awaited, if given.
+
+        Returns a list of dicts as returned by :meth:`launch`,
+        one for each server that was launched.
+        """
+        if not self.create_user:
+            raise web.HTTPError(400, "Batch launches need temporary users, which are disabled with authentication")
+
+        semaphore = Semaphore(concurrency)
+        servers = []
+        failed = 0
+
+        async def launch_one():
+            nonlocal failed
+            async with semaphore:
+                username = self.unique_name_from_repo(repo_url)
+                state = LaunchState()
+                retry_delay = self.retry_delay
+                for i in range(self.retries):
+                    try:
+                        # batches don't count towards popular images, nor use their warm servers
+                        server_info = await self.launch(image, username, repo_url=repo_url,
+                                                        use_warm_pool=False,
+                                                        just_built=just_built, state=state)
+                    except Exception as e:
+                        if i + 1 == self.retries:
+                            app_log.error("Failed to launch %s in batch: %s", image, e)
+                            failed += 1
+                            break
+                        app_log.error("Retrying launch of %s in batch after error: %s", image, e)
+                        await gen.sleep(retry_delay)
+                        retry_delay *= 2
+                    else:
+                        servers.append(server_info)
+                        break
+            if progress_callback:
+                await progress_callback(len(servers), failed)
+
+        await gen.multi([launch_one() for i in range(count)])
+        return servers
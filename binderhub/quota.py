@@ -0,0 +1,294 @@
+"""
+Counting of running servers per repo, for launch quotas
+"""
+from collections import Counter, defaultdict, deque
+from datetime import timedelta
+import json
+import os
+import re
+import time
+
+from prometheus_client import Gauge
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition, Event
+from tornado.log import app_log
+from tornado.util import TimeoutError
+
+from .utils import PodWatcher
+
+QUOTA_QUEUED = Gauge(
+    'binderhub_quota_queued_launches',
+    'Launches waiting for their repo to be below its quota',
+)
+
+SERVER_LABEL_SELECTOR = 'app=jupyterhub,component=singleuser-server'
+
+
+def image_repo(image):
+    """Return an image name without its tag
+
+    The image name without tag is unique per repo,
+    so it is used to count the servers running a given repo.
+    """
+    return image.rsplit(':', 1)[0]
+
+
+class QuotaTiers:
+    """Per-repo quotas, loaded from a JSON file
+
+    The file lists tiers, each with a regular expression matched
+    (case-insensitively, from the start) against the repo's identity,
+    e.g. ``github.com/org/repo``, and the quota for repos matching it::
+
+        {
+          "default": 100,
+          "tiers": [
+            {"pattern": "github.com/my-course/", "quota": 500},
+            {"pattern": "github.com/org/repo$", "quota": 0}
+          ]
+        }
+
+    The first matching tier applies.
+    A quota of 0 means no quota, e.g. for trusted repos.
+    Repos that don't match any tier get the file's ``default``,
+    if there is one, or the ``default`` passed in.
+
+    All patterns are compiled into a single regular expression,
+    so finding the tier of a repo takes one match.
+    The file is reloaded when it changes, checked at most
+    every `check_interval` seconds.
+    """
+
+    def __init__(self, path, default=0, check_interval=10):
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+        self._mtime = None
+        self._last_check = 0
+        # load synchronously the first time, so config errors are fatal
+        self._load()
+
+    def _load(self):
+        """Load the file, compiling all tier patterns into one expression"""
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path) as f:
+            config = json.load(f)
+        tiers = config.get('tiers', [])
+        quotas = []
+        patterns = []
+        for i, tier in enumerate(tiers):
+            pattern = tier['pattern']
+            # compile separately first, for a helpful error message
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError("Invalid quota pattern %r: %s" % (pattern, e))
+            patterns.append('(?P<tier{}>{})'.format(i, pattern))
+            quotas.append(int(tier['quota']))
+        self._pattern = re.compile('|'.join(patterns), re.IGNORECASE) if patterns else None
+        self._quotas = quotas
+        self._file_default = config.get('default')
+        self._mtime = mtime
+        app_log.info("Loaded %i quota tiers from %s", len(quotas), self.path)
+
+    def reload_if_changed(self):
+        """Reload the file if it has been modified
+
+        Errors are logged, keeping the quotas from before.
+        """
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            if os.stat(self.path).st_mtime != self._mtime:
+                self._load()
+        except Exception:
+            app_log.exception("Failed to reload quota tiers from %s", self.path)
+
+    def quota_for(self, repo_identity):
+        """Return the quota for a repo, given its identity"""
+        self.reload_if_changed()
+        if self._pattern is not None:
+            match = self._pattern.match(repo_identity)
+            if match:
+                return self._quotas[int(match.lastgroup[len('tier'):])]
+        if self._file_default is not None:
+            return self._file_default
+        return self.default
+
+
+class LaunchQuota(PodWatcher):
+    """Count running servers per repo and make launches wait below a quota
+
+    Servers are counted by the image (without tag) of their containers.
+    Counts are kept up to date by watching the singleuser server pods
+    (see PodWatcher), instead of listing all of them for every launch.
+
+    Launches admitted by :meth:`acquire` count towards the quota
+    until :meth:`release` is called, so that a burst of launches
+    can't exceed the quota before their pods show up in the watch.
+    """
+
+    thread_name = 'launch-quota-watch'
+    pods_description = 'server pods for quotas'
+
+    # the longest (seconds) launches wait for the first list of pods
+    SYNC_TIMEOUT = 30
+
+    def __init__(self, kube, namespace, resync_interval=300, unclaimed_servers=None):
+        super().__init__(kube, namespace, SERVER_LABEL_SELECTOR, resync_interval)
+        # callable returning the number of servers of a repo that are running
+        # but not handed out to anyone (warm servers), which don't count
+        self.unclaimed_servers = unclaimed_servers
+
+        # pod name -> set of repos (image without tag) of its containers
+        self._pod_repos = {}
+        self._counts = Counter()
+        # launches admitted but not finished
+        self._reserved = Counter()
+        # launches waiting for a repo to be below its quota, in order
+        self._queues = defaultdict(deque)
+        self._changed = defaultdict(Condition)
+        self._synced = Event()
+        # set once pods have been listed, or listing them failed or took too long,
+        # so launches wait for the first list at most once
+        self._sync_settled = Event()
+
+    @property
+    def total(self):
+        """The total number of servers running"""
+        return len(self._pod_repos)
+
+    def count(self, repo):
+        """The number of servers running, or being launched, for a repo"""
+        running = self._counts[repo]
+        if self.unclaimed_servers is not None:
+            # pods of warm servers may not have been seen yet
+            running = max(running - self.unclaimed_servers(repo), 0)
+        return running + self._reserved[repo]
+
+    @staticmethod
+    def _is_running(pod):
+        """Whether a pod counts towards quotas
+
+        Pods that are shutting down don't, so waiting launches can start
+        as soon as a server is stopped.
+        """
+        if pod.metadata.deletion_timestamp:
+            return False
+        return pod.status.phase not in {'Succeeded', 'Failed'}
+
+    @staticmethod
+    def _repos_of(pod):
+        return {image_repo(container.image) for container in pod.spec.containers}
+
+    def _pods_listed(self, pods):
+        self._reset({
+            pod.metadata.name: self._repos_of(pod)
+            for pod in pods if self._is_running(pod)
+        })
+
+    def _pod_changed(self, pod, deleted):
+        if deleted or not self._is_running(pod):
+            repos = None
+        else:
+            repos = self._repos_of(pod)
+        self._set_pod(pod.metadata.name, repos)
+
+    def _watch_failed(self):
+        # don't keep launches waiting for a list that is failing
+        self._sync_settled.set()
+
+    def _notify(self, repo):
+        if repo in self._changed:
+            self._changed[repo].notify_all()
+
+    def _reset(self, pod_repos):
+        """Replace all pod counts with the result of a full list"""
+        old_counts = self._counts
+        self._pod_repos = pod_repos
+        self._counts = Counter(repo for repos in pod_repos.values() for repo in repos)
+        self._synced.set()
+        self._sync_settled.set()
+        for repo in old_counts:
+            if self._counts[repo] < old_counts[repo]:
+                self._notify(repo)
+
+    def _set_pod(self, name, repos):
+        """Update pod counts for one pod, removing it if `repos` is None"""
+        old_repos = self._pod_repos.pop(name, set())
+        if repos:
+            self._pod_repos[name] = repos
+        else:
+            repos = set()
+        for repo in repos - old_repos:
+            self._counts[repo] += 1
+        for repo in old_repos - repos:
+            self._counts[repo] -= 1
+            if self._counts[repo] <= 0:
+                del self._counts[repo]
+            self._notify(repo)
+
+    async def acquire(self, repo, quota, timeout, position_callback=None, count=1):
+        """Wait until `count` more servers of `repo` fit in its `quota`
+
+        Launches of the same repo are admitted in the order they arrive.
+        While waiting, the launch's position in the queue is sent to
+        ``position_callback``, if given, whenever it changes.
+
+        Returns False if the repo didn't get below its quota
+        within `timeout` seconds, True otherwise.
+        Every call that returns True must be followed by a call to :meth:`release`
+        with the same `count`.
+        """
+        deadline = IOLoop.current().time() + timeout
+        if not self._sync_settled.is_set():
+            # wait for the first list of pods
+            try:
+                await self._sync_settled.wait(timeout=timedelta(seconds=self.SYNC_TIMEOUT))
+            except TimeoutError:
+                if not self._sync_settled.is_set():
+                    app_log.warning("Server pods not listed after %s seconds", self.SYNC_TIMEOUT)
+                    self._sync_settled.set()
+        if not self._synced.is_set():
+            app_log.debug("Server pods not listed yet, checking quota of %s without them", repo)
+
+        queue = self._queues[repo]
+        ticket = object()
+        queue.append(ticket)
+        QUOTA_QUEUED.inc()
+        try:
+            reported_position = None
+            while True:
+                position = queue.index(ticket) + 1
+                if position == 1 and self.count(repo) + count <= quota:
+                    break
+                remaining = deadline - IOLoop.current().time()
+                if remaining <= 0:
+                    return False
+                if position_callback and position != reported_position:
+                    reported_position = position
+                    await position_callback(position)
+                await self._changed[repo].wait(timeout=timedelta(seconds=remaining))
+        finally:
+            queue.remove(ticket)
+            QUOTA_QUEUED.dec()
+            if queue:
+                # the launches behind this one have moved up
+                self._notify(repo)
+            else:
+                self._queues.pop(repo, None)
+                self._changed.pop(repo, None)
+        self._reserved[repo] += count
+        return True
+
+    def release(self, repo, count=1):
+        """Record that a launch admitted by :meth:`acquire` has finished
+
+        If it succeeded, its servers are now counted from the pod watch.
+        """
+        self._reserved[repo] -= count
+        if self._reserved[repo] <= 0:
+            del self._reserved[repo]
+        self._notify(repo)
@@ -8,11 +8,14 @@ Note: When adding a new repo provider, add it to the allowed values for
       repo providers in event-schemas/launch.json.
 """
 from datetime import timedelta
+import hashlib
+import hmac
 import json
 import os
 import time
 import urllib.parse
 import re
+from urllib.parse import urlparse
 
 from prometheus_client import Gauge
 
@@ -20,14 +23,18 @@ from tornado import gen
 from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
 from tornado.httputil import url_concat
 
-from traitlets import Dict, Unicode, Bool, default, List, observe
+from traitlets import Dict, Unicode, Bool, Integer, default, List, observe
 from traitlets.config import LoggingConfigurable
 
-from .utils import Cache
+from .launcher import _ssh_repo_pat
+from .utils import Cache, CircuitBreaker
 
 GITHUB_RATE_LIMIT = Gauge('binderhub_github_rate_limit_remaining', 'GitHub rate limit remaining')
 SHA1_PATTERN = re.compile(r'[0-9a-f]{40}')
 
+# hosts where repository paths are case-insensitive
+CASE_INSENSITIVE_HOSTS = {'github.com', 'gist.github.com', 'gitlab.com'}
+
 
 def tokenize_spec(spec):
     """Tokenize a GitHub-style spec into parts, error if spec invalid."""
@@ -48,6 +55,72 @@ def strip_suffix(text, suffix):
     return text
 
 
+def strip_ref_prefix(ref):
+    """Strip refs/heads/ or refs/tags/ from a git ref as sent in push webhooks"""
+    for prefix in ('refs/heads/', 'refs/tags/'):
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    return ref
+
+
+# the `after` sha sent in a push webhook when a ref has been deleted
+NULL_SHA = '0' * 40
+
+# files that define a repo's environment, as read by repo2docker
+ENVIRONMENT_FILES = {
+    'apt.txt', 'DESCRIPTION', 'default.nix', 'Dockerfile', 'environment.yml',
+    'install.R', 'Manifest.toml', 'manifest.xml', 'Pipfile', 'Pipfile.lock',
+    'postBuild', 'Project.toml', 'REQUIRE', 'requirements.txt', 'runtime.txt',
+    'setup.py', 'start',
+}
+# if one of these directories exists, repo2docker only reads files in it
+BINDER_DIRS = ('binder', '.binder')
+
+
+def environment_hash(entries):
+    """Return a hash of the files that define a repo's environment
+
+    `entries` are (name, type, object id) of the top-level tree of the repo,
+    where type is 'blob' or 'tree'. Git object ids are hashes of their content,
+    so the hash changes when (and only when) an environment file changes.
+    A binder directory is hashed as a whole.
+    """
+    entries = list(entries)
+    trees = {name: object_id for name, entry_type, object_id in entries if entry_type == 'tree'}
+    binder_dir = next((name for name in BINDER_DIRS if name in trees), None)
+    if binder_dir:
+        selected = [(binder_dir, trees[binder_dir])]
+    else:
+        selected = sorted(
+            (name, object_id) for name, entry_type, object_id in entries
+            if entry_type == 'blob' and name in ENVIRONMENT_FILES
+        )
+    h = hashlib.sha256()
+    for name, object_id in selected:
+        h.update('{} {}\n'.format(name, object_id).encode('utf8'))
+    return h.hexdigest()
+
+
+def canonical_repo_identity(repo_url):
+    """Normalize a git repo URL to an identity shared by all URLs of the same repo
+
+    e.g. https://GitHub.com/User/Repo.git and git@github.com:user/repo
+    both become github.com/user/repo
+    """
+    if '://' not in repo_url and _ssh_repo_pat.match(repo_url):
+        # ssh url
+        host, path = repo_url.split(':', 1)
+    else:
+        parsed = urlparse(repo_url)
+        host, path = parsed.netloc, parsed.path
+    # drop credentials
+    host = host.rsplit('@', 1)[-1].lower()
+    path = strip_suffix(path.strip('/'), '.git').strip('/')
+    if host in CASE_INSENSITIVE_HOSTS:
+        path = path.lower()
+    return '{}/{}'.format(host, path)
+
+
 class RepoProvider(LoggingConfigurable):
     """Base class for a repo provider"""
     name = Unicode(
@@ -80,6 +153,97 @@ class RepoProvider(LoggingConfigurable):
         """,
     )
 
+    webhook_secret = Unicode(
+        "",
+        config=True,
+        help="""
+        Shared secret for verifying push webhooks sent to /hooks/<provider>.
+
+        Refs pushed via a verified webhook are stored in the resolved-ref cache,
+        so launches of the pushed branch do not need to ask the provider's API.
+
+        Webhooks are not accepted if this is empty.
+        """,
+    )
+
+    pushed_ref_max_age = Integer(
+        24 * 3600,
+        config=True,
+        help="""
+        Maximum age (in seconds) of a ref received via webhook
+        before the provider's API is asked again.
+
+        Guards against serving stale refs forever if a webhook
+        stops being delivered.
+        """,
+    )
+
+    circuit_breaker_threshold = Integer(
+        5,
+        config=True,
+        help="""
+        Number of consecutive failed requests to the provider's API
+        before requests stop being sent for circuit_breaker_timeout seconds.
+        """,
+    )
+
+    circuit_breaker_timeout = Integer(
+        30,
+        config=True,
+        help="""
+        Time (seconds) to stop sending requests to the provider's API
+        after circuit_breaker_threshold consecutive failures.
+        """,
+    )
+
+    repo_size_max_age = Integer(
+        3600,
+        config=True,
+        help="""
+        Time (seconds) to cache repository sizes used to reject oversized builds.
+        """,
+    )
+
+    # shared cache of repository sizes
+    size_cache = Cache(1024)
+
+    # shared circuit breakers, one per provider class and host
+    _circuit_breakers = {}
+
+    @property
+    def circuit_breaker(self):
+        hostname = getattr(self, 'hostname', '')
+        key = (self.__class__.__name__, hostname)
+        if key not in self._circuit_breakers:
+            self._circuit_breakers[key] = CircuitBreaker(
+                '{} {}'.format(self.name, hostname).strip(),
+                failure_threshold=self.circuit_breaker_threshold,
+                reset_timeout=self.circuit_breaker_timeout,
+            )
+        return self._circuit_breakers[key]
+
+    async def fetch(self, req):
+        """Fetch a request to the provider's API through its circuit breaker
+
+        Server errors and connection failures count as failures.
+        Other errors (e.g. 404) mean the API is healthy.
+        """
+        breaker = self.circuit_breaker
+        breaker.check()
+        try:
+            resp = await AsyncHTTPClient().fetch(req)
+        except HTTPError as e:
+            if e.code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return resp
+
     def is_banned(self):
         """
         Return true if the given spec has been banned
@@ -103,6 +267,108 @@ class RepoProvider(LoggingConfigurable):
         """Return a unique build slug"""
         raise NotImplementedError("Must be overriden in the child class")
 
+    def get_repo_identity(self):
+        """Return a normalized identity for the repository
+
+        Specs referring to the same repository return the same identity,
+        regardless of which provider or spelling was used.
+        Used for cache keys.
+        """
+        return canonical_repo_identity(self.get_repo_url())
+
+    def get_ref_cache_key(self):
+        """Return the key for this spec's ref in the resolved-ref cache"""
+        return '{}@{}'.format(self.get_repo_identity(), self.unresolved_ref)
+
+    @classmethod
+    def build_slug_from_identity(cls, identity, config=None):
+        """Return the build slug this provider uses for a repo identity
+
+        Used by GitRepoProvider to share images with the dedicated provider
+        for the same repository.
+        `config` is the traitlets config, for the provider's configured hostname.
+        Returns None if the identity isn't handled by this provider.
+        """
+        return None
+
+    @classmethod
+    def _configured_value(cls, config, name):
+        """Return the value of trait `name` for this class in `config`, without an instance"""
+        value = cls.class_traits()[name].default()
+        if config is None:
+            return value
+        # subclasses' config takes precedence, as for instances
+        for klass in reversed(cls.mro()):
+            section = config.get(klass.__name__, {})
+            if name in section:
+                value = section[name]
+        return value
+
+    @classmethod
+    def spec_from_webhook(cls, headers, payload):
+        """Return ``(spec, resolved_ref)`` for a push webhook payload
+
+        ``resolved_ref`` is None if the ref was deleted.
+        Returns None for events that do not describe a push (e.g. pings).
+        """
+        raise NotImplementedError("Webhooks are not supported by %s" % cls.__name__)
+
+    def verify_webhook(self, headers, body):
+        """Return True if a webhook request was signed with our webhook_secret"""
+        raise NotImplementedError("Webhooks are not supported by %s" % self.__class__.__name__)
+
+    def set_pushed_ref(self, resolved_ref):
+        """Record a ref received via webhook in the resolved-ref cache
+
+        ``resolved_ref=None`` removes the ref from the cache.
+        """
+        raise NotImplementedError("Webhooks are not supported by %s" % self.__class__.__name__)
+
+    def get_last_resolved_ref(self):
+        """Return the last successfully resolved ref from the ref cache
+
+        Used to keep launching when the provider's API is unavailable.
+        Returns None if there is no cached ref.
+        """
+        return None
+
+    @gen.coroutine
+    def get_repo_size(self):
+        """Return the size of the repository in bytes, if the provider knows it
+
+        Used to reject oversized repos before a build is started.
+        Returns None if the size is unknown.
+        """
+        return None
+
+    @gen.coroutine
+    def _cached_repo_size(self, key, fetch_size):
+        """Get a repo size from size_cache, calling fetch_size on a miss"""
+        cached = self.size_cache.get(key)
+        if cached and time.monotonic() - cached['time'] < self.repo_size_max_age:
+            return cached['size']
+        size = yield fetch_size()
+        self.size_cache.set(key, {'size': size, 'time': time.monotonic()})
+        return size
+
+    @gen.coroutine
+    def get_environment_hash(self):
+        """Return a hash of the files defining the repo's environment at the resolved ref
+
+        Builds of commits with the same hash can reuse each other's image layers
+        (see environment_hash).
+        Returns None if the provider can't tell.
+        """
+        return None
+
+    def _get_pushed_ref(self, cached):
+        """Return the sha from a cache entry if it came from a recent webhook"""
+        if not cached or not cached.get('pushed'):
+            return None
+        if time.monotonic() - cached['pushed'] > self.pushed_ref_max_age:
+            return None
+        return cached['sha']
+
     @staticmethod
     def sha1_validate(sha1):
         if not SHA1_PATTERN.match(sha1):
@@ -157,7 +423,13 @@ class GitRepoProvider(RepoProvider):
         return self.repo
 
     def get_build_slug(self):
-        return self.repo
+        identity = self.get_repo_identity()
+        # use the same images as the dedicated provider for the same repo
+        for Provider in (GitHubRepoProvider, GistRepoProvider, GitLabRepoProvider):
+            slug = Provider.build_slug_from_identity(identity, self.config)
+            if slug:
+                return slug
+        return identity
 
 
 class GitLabRepoProvider(RepoProvider):
@@ -174,6 +446,9 @@ class GitLabRepoProvider(RepoProvider):
 
     name = Unicode('GitLab')
 
+    # shared cache for resolved refs
+    cache = Cache(1024)
+
     hostname = Unicode('gitlab.com', config=True,
         help="""The host of the GitLab instance
 
@@ -225,18 +500,26 @@ class GitLabRepoProvider(RepoProvider):
         if not self.unresolved_ref:
             raise ValueError("An unresolved ref is required")
 
+    def _ref_api_url(self):
+        return "https://{hostname}/api/v4/projects/{namespace}/repository/commits/{ref}".format(
+            hostname=self.hostname,
+            namespace=urllib.parse.quote(self.namespace, safe=''),
+            ref=urllib.parse.quote(self.unresolved_ref, safe=''),
+        )
+
     @gen.coroutine
     def get_resolved_ref(self):
         if hasattr(self, 'resolved_ref'):
             return self.resolved_ref
 
-        namespace = urllib.parse.quote(self.namespace, safe='')
-        client = AsyncHTTPClient()
-        api_url = "https://{hostname}/api/v4/projects/{namespace}/repository/commits/{ref}".format(
-            hostname=self.hostname,
-            namespace=namespace,
-            ref=urllib.parse.quote(self.unresolved_ref, safe=''),
-        )
+        cache_key = self.get_ref_cache_key()
+        api_url = self._ref_api_url()
+        pushed_ref = self._get_pushed_ref(self.cache.get(cache_key))
+        if pushed_ref:
+            self.log.debug("Using pushed ref for %s: %s", api_url, pushed_ref)
+            self.resolved_ref = pushed_ref
+            return self.resolved_ref
+
         self.log.debug("Fetching %s", api_url)
 
         if self.auth:
@@ -244,7 +527,7 @@ class GitLabRepoProvider(RepoProvider):
             api_url = url_concat(api_url, self.auth)
 
         try:
-            resp = yield client.fetch(api_url, user_agent="BinderHub")
+            resp = yield self.fetch(HTTPRequest(api_url, user_agent="BinderHub"))
         except HTTPError as e:
             if e.code == 404:
                 return None
@@ -253,11 +536,104 @@ class GitLabRepoProvider(RepoProvider):
 
         ref_info = json.loads(resp.body.decode('utf-8'))
         self.resolved_ref = ref_info['id']
+        self.cache.set(cache_key, {'sha': self.resolved_ref})
         return self.resolved_ref
 
-    def get_build_slug(self):
+    def get_last_resolved_ref(self):
+        cached = self.cache.get(self.get_ref_cache_key())
+        return cached['sha'] if cached else None
+
+    @gen.coroutine
+    def get_repo_size(self):
+        api_url = "https://{hostname}/api/v4/projects/{namespace}".format(
+            hostname=self.hostname,
+            namespace=urllib.parse.quote(self.namespace, safe=''),
+        )
+
+        async def fetch_size():
+            url = url_concat(api_url, dict(self.auth, statistics='true'))
+            try:
+                resp = await self.fetch(HTTPRequest(url, user_agent="BinderHub"))
+            except HTTPError as e:
+                if e.code == 404:
+                    return None
+                raise
+            project = json.loads(resp.body.decode('utf-8'))
+            # statistics are only included for authenticated requests
+            # with at least reporter access
+            return project.get('statistics', {}).get('repository_size')
+
+        return (yield self._cached_repo_size(self.get_repo_identity(), fetch_size))
+
+    @gen.coroutine
+    def get_environment_hash(self):
+        ref = yield self.get_resolved_ref()
+        if ref is None:
+            return None
+        api_url = "https://{hostname}/api/v4/projects/{namespace}/repository/tree".format(
+            hostname=self.hostname,
+            namespace=urllib.parse.quote(self.namespace, safe=''),
+        )
+        self.log.debug("Fetching %s", api_url)
+        url = url_concat(api_url, dict(self.auth, ref=ref, per_page='100'))
+        try:
+            resp = yield self.fetch(HTTPRequest(url, user_agent="BinderHub"))
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        tree = json.loads(resp.body.decode('utf-8'))
+        return environment_hash((entry['name'], entry['type'], entry['id']) for entry in tree)
+
+    @staticmethod
+    def _build_slug(namespace):
         # escape the name and replace dashes with something else.
-        return '-'.join(p.replace('-', '_-') for p in self.namespace.split('/'))
+        return '-'.join(p.replace('-', '_-') for p in namespace.lower().split('/'))
+
+    def get_build_slug(self):
+        return self._build_slug(self.namespace)
+
+    def get_repo_identity(self):
+        # GitLab namespaces are case-insensitive, including self-hosted instances
+        return '{}/{}'.format(self.hostname, self.namespace).lower()
+
+    @classmethod
+    def build_slug_from_identity(cls, identity, config=None):
+        host, _, namespace = identity.partition('/')
+        # hosts are lowercase in identities, _build_slug lowercases the namespace
+        if host != cls._configured_value(config, 'hostname').lower() or '/' not in namespace:
+            return None
+        return cls._build_slug(namespace)
+
+    @classmethod
+    def spec_from_webhook(cls, headers, payload):
+        if headers.get('X-Gitlab-Event') not in ('Push Hook', 'Tag Push Hook'):
+            return None
+        namespace = payload['project']['path_with_namespace']
+        ref = strip_ref_prefix(payload['ref'])
+        spec = '{}/{}'.format(
+            urllib.parse.quote(namespace, safe=''),
+            urllib.parse.quote(ref, safe=''),
+        )
+        resolved_ref = payload['after']
+        if resolved_ref == NULL_SHA:
+            resolved_ref = None
+        return spec, resolved_ref
+
+    def verify_webhook(self, headers, body):
+        if not self.webhook_secret:
+            return False
+        # GitLab doesn't sign requests, it sends the secret token back to us
+        token = headers.get('X-Gitlab-Token', '')
+        return hmac.compare_digest(token.encode('utf8'), self.webhook_secret.encode('utf8'))
+
+    def set_pushed_ref(self, resolved_ref):
+        cache_key = self.get_ref_cache_key()
+        if resolved_ref is None:
+            self.cache.pop(cache_key, None)
+            return
+        self.sha1_validate(resolved_ref)
+        self.cache.set(cache_key, {'sha': resolved_ref, 'pushed': time.monotonic()})
 
     def get_repo_url(self):
         return "https://{hostname}/{namespace}.git".format(
@@ -350,7 +726,6 @@ class GitHubRepoProvider(RepoProvider):
 
     @gen.coroutine
     def github_api_request(self, api_url, etag=None):
-        client = AsyncHTTPClient()
         if self.auth:
             # Add auth params. After logging!
             api_url = url_concat(api_url, self.auth)
@@ -361,7 +736,7 @@ class GitHubRepoProvider(RepoProvider):
         req = HTTPRequest(api_url, headers=headers, user_agent="BinderHub")
 
         try:
-            resp = yield client.fetch(req)
+            resp = yield self.fetch(req)
         except HTTPError as e:
             if e.code == 304:
                 resp = e.response
@@ -417,18 +792,28 @@ class GitHubRepoProvider(RepoProvider):
         return resp
 
 
+    def _ref_api_url(self):
+        return "https://api.{hostname}/repos/{user}/{repo}/commits/{ref}".format(
+            user=self.user, repo=self.repo, ref=self.unresolved_ref,
+            hostname=self.hostname,
+        )
+
     @gen.coroutine
     def get_resolved_ref(self):
         if hasattr(self, 'resolved_ref'):
             return self.resolved_ref
 
-        api_url = "https://api.{hostname}/repos/{user}/{repo}/commits/{ref}".format(
-            user=self.user, repo=self.repo, ref=self.unresolved_ref,
-            hostname=self.hostname,
-        )
+        cache_key = self.get_ref_cache_key()
+        api_url = self._ref_api_url()
+        cached = self.cache.get(cache_key)
+        pushed_ref = self._get_pushed_ref(cached)
+        if pushed_ref:
+            self.log.debug("Using pushed ref for %s: %s", api_url, pushed_ref)
+            self.resolved_ref = pushed_ref
+            return self.resolved_ref
+
         self.log.debug("Fetching %s", api_url)
-        cached = self.cache.get(api_url)
-        if cached:
+        if cached and cached.get('etag'):
             etag = cached['etag']
             self.log.debug("Cache hit for %s: %s", api_url, etag)
         else:
@@ -441,7 +826,7 @@ class GitHubRepoProvider(RepoProvider):
             self.log.info("Using cached ref for %s: %s", api_url, cached['sha'])
             self.resolved_ref = cached['sha']
             # refresh cache entry
-            self.cache.move_to_end(api_url)
+            self.cache.move_to_end(cache_key)
             return self.resolved_ref
         elif cached:
             self.log.debug("Cache outdated for %s", api_url)
@@ -455,7 +840,7 @@ class GitHubRepoProvider(RepoProvider):
         # store resolved ref and cache for later
         self.resolved_ref = ref_info['sha']
         self.cache.set(
-            api_url,
+            cache_key,
             {
                 'etag': resp.headers.get('ETag'),
                 'sha': self.resolved_ref,
@@ -463,8 +848,98 @@ class GitHubRepoProvider(RepoProvider):
         )
         return self.resolved_ref
 
+    def get_last_resolved_ref(self):
+        cached = self.cache.get(self.get_ref_cache_key())
+        return cached['sha'] if cached else None
+
+    @gen.coroutine
+    def get_repo_size(self):
+        api_url = "https://api.{hostname}/repos/{user}/{repo}".format(
+            user=self.user, repo=self.repo, hostname=self.hostname,
+        )
+
+        async def fetch_size():
+            resp = await self.github_api_request(api_url)
+            if resp is None:
+                return None
+            repo_info = json.loads(resp.body.decode('utf-8'))
+            # GitHub reports size in kilobytes
+            return repo_info['size'] * 1024
+
+        return (yield self._cached_repo_size(self.get_repo_identity(), fetch_size))
+
+    @gen.coroutine
+    def get_environment_hash(self):
+        ref = yield self.get_resolved_ref()
+        if ref is None:
+            return None
+        api_url = "https://api.{hostname}/repos/{user}/{repo}/git/trees/{ref}".format(
+            user=self.user, repo=self.repo, ref=ref, hostname=self.hostname,
+        )
+        self.log.debug("Fetching %s", api_url)
+        resp = yield self.github_api_request(api_url)
+        if resp is None:
+            return None
+        tree = json.loads(resp.body.decode('utf-8'))
+        return environment_hash((entry['path'], entry['type'], entry['sha']) for entry in tree['tree'])
+
     def get_build_slug(self):
-        return '{user}-{repo}'.format(user=self.user, repo=self.repo)
+        # GitHub user and repo names are case-insensitive
+        return '{user}-{repo}'.format(user=self.user, repo=self.repo).lower()
+
+    def get_repo_identity(self):
+        return '{}/{}/{}'.format(self.hostname, self.user, self.repo).lower()
+
+    @classmethod
+    def build_slug_from_identity(cls, identity, config=None):
+        parts = identity.split('/')
+        if len(parts) != 3 or parts[0] != cls._configured_value(config, 'hostname').lower():
+            return None
+        # paths are only lowercased in identities of well-known hosts,
+        # GitHub user and repo names are case-insensitive on any host
+        return '{}-{}'.format(parts[1], parts[2]).lower()
+
+    @classmethod
+    def spec_from_webhook(cls, headers, payload):
+        if headers.get('X-GitHub-Event') != 'push':
+            return None
+        full_name = payload['repository']['full_name']
+        ref = strip_ref_prefix(payload['ref'])
+        spec = '{}/{}'.format(full_name, ref)
+        resolved_ref = payload['after']
+        if payload.get('deleted') or resolved_ref == NULL_SHA:
+            resolved_ref = None
+        return spec, resolved_ref
+
+    def verify_webhook(self, headers, body):
+        if not self.webhook_secret:
+            return False
+        secret = self.webhook_secret.encode('utf8')
+        for header, digestmod in (
+            ('X-Hub-Signature-256', hashlib.sha256),
+            ('X-Hub-Signature', hashlib.sha1),
+        ):
+            signature = headers.get(header)
+            if not signature:
+                continue
+            expected = '{}={}'.format(
+                digestmod().name,
+                hmac.new(secret, body, digestmod).hexdigest(),
+            )
+            return hmac.compare_digest(signature.encode('utf8'), expected.encode('utf8'))
+        return False
+
+    def set_pushed_ref(self, resolved_ref):
+        cache_key = self.get_ref_cache_key()
+        if resolved_ref is None:
+            self.cache.pop(cache_key, None)
+            return
+        self.sha1_validate(resolved_ref)
+        self.cache.set(cache_key, {
+            'etag': None,
+            'sha': resolved_ref,
+            'pushed': time.monotonic(),
+        })
 
 
 class GistRepoProvider(GitHubRepoProvider):
@@ -499,6 +974,34 @@ class GistRepoProvider(GitHubRepoProvider):
     def get_repo_url(self):
         return f'https://gist.github.com/{self.gist_id}.git'
 
+    def get_repo_identity(self):
+        return canonical_repo_identity(self.get_repo_url())
+
+    @classmethod
+    def build_slug_from_identity(cls, identity, config=None):
+        host, _, gist_id = identity.partition('/')
+        if host != 'gist.github.com' or not gist_id or '/' in gist_id:
+            return None
+        return gist_id
+
+    @classmethod
+    def spec_from_webhook(cls, headers, payload):
+        raise NotImplementedError("Webhooks are not supported for gists")
+
+    def get_last_resolved_ref(self):
+        # gist refs are not cached
+        return None
+
+    @gen.coroutine
+    def get_repo_size(self):
+        # the gist API doesn't report a total size
+        return None
+
+    @gen.coroutine
+    def get_environment_hash(self):
+        # gists are small, reusing layers wouldn't save much
+        return None
+
     @gen.coroutine
     def get_resolved_ref(self):
         if hasattr(self, 'resolved_ref'):
@@ -65,15 +65,30 @@ Image.prototype.changeState = function(state, data) {
     }
 };
 
+// give up on an event stream after this many reconnects without an event
+var MAX_EVENT_STREAM_RECONNECTS = 5;
+
 Image.prototype.fetch = function() {
     var apiUrl = BASE_URL + 'build/' + this.providerSpec;
     this.eventSource = new EventSource(apiUrl);
     var that = this;
+    // reconnect attempts since the last event we received
+    var reconnects = 0;
     this.eventSource.onerror = function (err) {
+        if (that.eventSource.readyState === EventSource.CONNECTING &&
+            reconnects < MAX_EVENT_STREAM_RECONNECTS) {
+            // the connection was lost and the browser is reconnecting,
+            // resuming the stream after the last event we got (Last-Event-ID)
+            reconnects++;
+            console.warn("Lost connection to event stream, reconnecting", err);
+            return;
+        }
+        that.eventSource.close();
         console.error("Failed to construct event stream", err);
         that.changeState("failed", {"message": "Failed to connect to event stream\n"});
     };
     this.eventSource.addEventListener('message', function(event) {
+        reconnects = 0;
         var data = JSON.parse(event.data);
         // FIXME: Rename 'phase' to 'state' upstream
         // FIXME: fix case of phase/state upstream
@@ -0,0 +1,92 @@
+"""
+JSON status of builds and launches, for clients that don't need an event stream
+"""
+from http.client import responses
+import json
+
+from tornado import web
+from tornado.web import authenticated
+
+from .builder import BuildHandler
+
+
+class BuildStatusHandler(BuildHandler):
+    """Report the status of a spec as a single JSON document
+
+    The status comes only from in-memory state:
+    the resolved-ref cache, images recently found in the registry
+    and the most recent /build stream for the same spec.
+    What isn't cached is reported as 'unknown'.
+
+    With ``?wait=<seconds>``, waits for a build or launch in progress
+    to finish (up to MAX_WAIT seconds) before responding.
+    """
+
+    url_prefix = '/api/builds/'
+    # the longest (seconds) a request can wait for a build or launch to finish
+    MAX_WAIT = 300
+
+    # this is a regular JSON API, not an event stream
+    send_error = web.RequestHandler.send_error
+
+    def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get('exc_info')
+        message = ''
+        if exc_info:
+            message = self.extract_message(exc_info)
+        self.set_header('content-type', 'application/json')
+        self.finish(json.dumps({
+            'status_code': status_code,
+            'message': message or responses.get(status_code, 'Unknown HTTP Error'),
+        }))
+
+    @authenticated
+    async def get(self, provider_prefix, _unescaped_spec):
+        spec = self.get_spec_from_request(self.url_prefix + provider_prefix).rstrip('/')
+        key = '%s:%s' % (provider_prefix, spec)
+        try:
+            wait = float(self.get_argument('wait', '0'))
+        except ValueError:
+            raise web.HTTPError(400, "wait must be a number of seconds")
+        wait = min(max(wait, 0), self.MAX_WAIT)
+
+        try:
+            provider = self.get_provider(provider_prefix, spec=spec)
+        except web.HTTPError:
+            raise
+        except Exception as e:
+            raise web.HTTPError(400, "Invalid spec %s: %s" % (spec, e))
+        if provider.is_banned():
+            raise web.HTTPError(403, "%s has been temporarily disabled from launching" % spec)
+
+        stream = self.latest_streams.get(key)
+        if wait and stream is not None and not stream.finished:
+            await stream.wait(wait)
+
+        # only cached state, so polling doesn't reach the provider or registry
+        ref = provider.get_last_resolved_ref()
+        if ref is None:
+            ref = image_found = 'unknown'
+        elif self.get_image_name(provider, ref) in self.found_images:
+            image_found = True
+        else:
+            image_found = 'unknown'
+
+        status = {
+            'provider': provider_prefix,
+            'spec': spec,
+            'resolved_ref': ref,
+            'image_found': image_found,
+            'phase': None,
+            'queue_position': None,
+            'in_progress': False,
+        }
+        if stream is not None:
+            status.update({
+                'phase': stream.phase,
+                'queue_position': stream.queue_position,
+                'in_progress': not stream.finished,
+            })
+        self.set_header('content-type', 'application/json')
+        self.set_header('cache-control', 'no-cache')
+        self.write(json.dumps(status))
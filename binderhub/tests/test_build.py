@@ -1,14 +1,25 @@
 """Test building repos"""
 
+import datetime
 import json
+import socket
 import sys
+import zlib
 from unittest import mock
 from urllib.parse import quote
 
 import pytest
-from tornado.httputil import url_concat
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httputil import HTTPHeaders, HTTPServerRequest, url_concat
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
 
-from binderhub.build import Build
+from binderhub.build import Build, BuildCleaner
+from binderhub.builder import (
+    BuildHandler, BuildWatchers, ConnectionParking, EventBuffer, EventStreamCompression,
+    PARKED_CONNECTIONS,
+)
 from .utils import async_requests
 
 
@@ -84,3 +95,407 @@ def test_git_credentials_passed_to_podspec_upon_submit():
     }
 
     assert env['GIT_CREDENTIAL_ENV'] == git_credentials
+
+
+def test_build_pod_template():
+    template = Build.make_pod_template(
+        builder_image='repo2docker:1', push_secret='push-secret', memory_limit='1G',
+        docker_host='/var/run/docker.sock', node_selector={'builds': 'yes'},
+        image_pull_policy='IfNotPresent',
+        overrides={
+            'metadata': {'annotations': {'team': 'binder'}},
+            'spec': {
+                'tolerations': [{'key': 'builds', 'operator': 'Exists'}],
+                'containers': [{'name': 'builder', 'env': [{'name': 'HTTP_PROXY', 'value': 'proxy'}]}],
+            },
+        },
+    )
+    builds = [
+        Build(
+            mock.MagicMock(), api=mock.MagicMock(), name='build-%i' % i,
+            namespace='build_namespace', repo_url='https://github.com/org/repo', ref='abc',
+            git_credentials='credentials', builder_image='repo2docker:1',
+            image_name='image:abc', push_secret='push-secret',
+            memory_limit='1G', docker_host='/var/run/docker.sock',
+            node_selector={'builds': 'yes'}, pod_template=template,
+        )
+        for i in range(2)
+    ]
+    pods = [build.make_pod() for build in builds]
+    for build, pod in zip(builds, pods):
+        assert pod.metadata.name == build.name
+        assert pod.metadata.labels == {'name': build.name, 'component': 'binderhub-build'}
+        assert pod.metadata.annotations == {'team': 'binder', 'binder-repo': 'https://github.com/org/repo'}
+        assert pod.spec.tolerations[0].key == 'builds'
+        assert pod.spec.node_selector == {'builds': 'yes'}
+        container = pod.spec.containers[0]
+        assert container.args == build.get_cmd()
+        assert container.image_pull_policy == 'IfNotPresent'
+        assert [env.name for env in container.env] == ['HTTP_PROXY', 'GIT_CREDENTIAL_ENV']
+        assert {volume.name for volume in pod.spec.volumes} == {'docker-socket', 'docker-push-secret'}
+    # builds don't change the template
+    assert template.metadata.name is None
+    assert [env.name for env in template.spec.containers[0].env] == ['HTTP_PROXY']
+
+    with pytest.raises(ValueError):
+        Build.make_pod_template(
+            builder_image='repo2docker:1', push_secret=None, memory_limit=0,
+            docker_host='/var/run/docker.sock', node_selector={},
+            overrides={'spec': {'containers': [{'image': 'other'}]}},
+        )
+
+
+def test_build_cache_from():
+    build = Build(
+        mock.MagicMock(), api=mock.MagicMock(), name='build', namespace='build_namespace',
+        repo_url='https://github.com/org/repo', ref='abc', git_credentials=None,
+        builder_image='repo2docker:1', image_name='image:abc', push_secret=None,
+        memory_limit=0, docker_host='/var/run/docker.sock', node_selector={},
+        cache_from='image:123',
+    )
+    cmd = build.get_cmd()
+    assert cmd[cmd.index('--cache-from') + 1] == 'image:123'
+    # the repo comes last
+    assert cmd[-1] == 'https://github.com/org/repo'
+
+
+def test_sticky_builds():
+    from prometheus_client import REGISTRY
+    template = Build.make_pod_template(
+        builder_image='repo2docker:1', push_secret=None, memory_limit=0,
+        docker_host='/var/run/docker.sock', node_selector={},
+        overrides={'spec': {'affinity': {'nodeAffinity': {'preferredDuringSchedulingIgnoredDuringExecution': [
+            {'weight': 1, 'preference': {'matchExpressions': [{'key': 'ssd', 'operator': 'Exists'}]}},
+        ]}}}},
+    )
+    build = Build(
+        mock.MagicMock(), api=mock.MagicMock(), name='build', namespace='build_namespace',
+        repo_url='https://github.com/org/repo', ref='abc', git_credentials=None,
+        builder_image='repo2docker:1', image_name='image:abc', push_secret=None,
+        memory_limit=0, docker_host='/var/run/docker.sock', node_selector={},
+        pod_template=template, preferred_node='node-1',
+    )
+    pod = build.make_pod()
+    terms = pod.spec.affinity.node_affinity.preferred_during_scheduling_ignored_during_execution
+    assert len(terms) == 2
+    assert terms[1].preference.match_fields[0].values == ['node-1']
+    # the template is unchanged
+    assert len(template.spec.affinity.node_affinity.preferred_during_scheduling_ignored_during_execution) == 1
+
+    def count(result):
+        return REGISTRY.get_sample_value(
+            'binderhub_build_node_affinity_time_seconds_count', {'result': result},
+        ) or 0
+
+    handler = mock.Mock(build_nodes=BuildHandler.build_nodes)
+    repo_url = 'https://github.com/org/sticky'
+    before = {result: count(result) for result in ('new', 'hit', 'miss')}
+    for node, preferred_node in [('node-1', None), ('node-1', 'node-1'), ('node-2', 'node-1')]:
+        handler.build.pod = mock.Mock(spec=['spec'])
+        handler.build.pod.spec.node_name = node
+        BuildHandler.record_build_node(handler, repo_url, preferred_node, 10)
+        assert BuildHandler.build_nodes.get(repo_url) == node
+    assert {result: count(result) - before[result] for result in before} == {'new': 1, 'hit': 1, 'miss': 1}
+    BuildHandler.build_nodes.pop(repo_url)
+
+
+@pytest.mark.gen_test
+def test_keepalives_sent_to_idle_streams(io_loop):
+    written = {}
+
+    def make_stream(name, closed=False):
+        handler = mock.Mock(_finished=False, KEEPALIVE_INTERVAL=BuildHandler.KEEPALIVE_INTERVAL)
+        handler.write = lambda chunk: written.setdefault(name, []).append(chunk)
+
+        def flush():
+            f = Future()
+            if closed:
+                f.set_exception(StreamClosedError())
+            else:
+                f.set_result(None)
+            return f
+        handler.flush = flush
+        BuildHandler.keep_alive(handler)
+        return handler
+
+    idle = make_stream('idle')
+    busy = make_stream('busy')
+    closed = make_stream('closed', closed=True)
+    finished = make_stream('finished')
+    finished._finished = True
+    assert BuildHandler._keepalive_callback is not None
+    now = io_loop.time()
+    for handler in (idle, closed, finished):
+        handler._last_write = now - BuildHandler.KEEPALIVE_INTERVAL
+    busy._last_write = now
+
+    BuildHandler._send_keepalives()
+    yield gen.moment
+    assert written == {'idle': [':keepalive\n\n'], 'closed': [':keepalive\n\n']}
+    assert BuildHandler._event_streams == {idle, busy}
+
+    BuildHandler._event_streams.clear()
+    BuildHandler._send_keepalives()
+    assert BuildHandler._keepalive_callback is None
+
+
+@pytest.mark.gen_test
+def test_connection_parking():
+    parking = ConnectionParking(timeout=0.1, check_interval=0.01)
+    parked_before = PARKED_CONNECTIONS._value.get()
+
+    def connection():
+        server, client = socket.socketpair()
+        return IOStream(server), client
+
+    closed_by_client, client = connection()
+    parking.park(closed_by_client)
+    timed_out, other_client = connection()
+    parking.park(timed_out)
+    assert PARKED_CONNECTIONS._value.get() == parked_before + 2
+
+    client.close()
+    yield gen.sleep(0.05)
+    assert closed_by_client.closed()
+    assert not timed_out.closed()
+    assert PARKED_CONNECTIONS._value.get() == parked_before + 1
+
+    yield gen.sleep(0.1)
+    assert timed_out.closed()
+    assert PARKED_CONNECTIONS._value.get() == parked_before
+    assert parking._callback is None
+    other_client.close()
+
+
+@pytest.mark.gen_test
+def test_event_buffer_resume():
+    buffer = EventBuffer('gh:org/repo/main')
+    assert buffer.append('one') == 1
+    assert buffer.append('two') == 2
+    received = []
+
+    async def follow(last_seen):
+        async for number, data in buffer.follow(last_seen):
+            received.append((number, data))
+
+    following = gen.convert_yielded(follow(1))
+    yield gen.moment
+    assert received == [(2, 'two')]
+    assert not following.done()
+
+    buffer.append('three')
+    buffer.finish()
+    yield following
+    assert received == [(2, 'two'), (3, 'three')]
+
+    # resuming a finished stream only sends the missed events
+    received.clear()
+    yield follow(0)
+    assert [number for number, data in received] == [1, 2, 3]
+
+
+@pytest.mark.gen_test
+def test_event_buffers_kept_until_resume_timeout():
+    handlers = []
+    for i in range(300):
+        handler = mock.Mock(
+            event_buffers=BuildHandler.event_buffers, RESUME_TIMEOUT=0.05,
+            stream_id='stream-%i' % i, event_buffer=EventBuffer('gh:org/repo/main'),
+            build=None,
+        )
+        BuildHandler.event_buffers[handler.stream_id] = handler.event_buffer
+        handlers.append(handler)
+    try:
+        # running streams are never evicted
+        assert all(h.stream_id in BuildHandler.event_buffers for h in handlers)
+        BuildHandler.on_finish(handlers[0])
+        assert handlers[0].event_buffer.finished
+        # finished streams can be resumed until RESUME_TIMEOUT
+        assert handlers[0].stream_id in BuildHandler.event_buffers
+        yield gen.sleep(0.1)
+        assert handlers[0].stream_id not in BuildHandler.event_buffers
+        assert handlers[1].stream_id in BuildHandler.event_buffers
+    finally:
+        for handler in handlers:
+            BuildHandler.event_buffers.pop(handler.stream_id, None)
+
+
+@pytest.mark.gen_test
+def test_event_buffer_capped():
+    buffer = EventBuffer('gh:org/repo/main', max_events=3)
+    buffer.append('waiting', {'phase': 'waiting'})
+    buffer.append('building', {'phase': 'building'})
+    for i in range(10):
+        buffer.append('log %i' % i, {'phase': 'building', 'message': 'log %i' % i})
+    buffer.append('ready', {'phase': 'ready'})
+    buffer.finish()
+    assert buffer.status.phase == 'ready'
+    assert buffer.status.finished
+
+    # only the phase changes and the latest events are kept
+    received = []
+
+    async def follow(last_seen):
+        async for number, data in buffer.follow(last_seen):
+            received.append(data)
+
+    yield follow(0)
+    assert received == ['waiting', 'building', 'log 8', 'log 9', 'ready']
+    received.clear()
+    yield follow(11)
+    assert received == ['log 9', 'ready']
+
+
+@pytest.mark.parametrize('accept_encoding, encoding, wbits', [
+    ('gzip, deflate, br', 'gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', 'deflate', zlib.MAX_WBITS),
+    ('gzip;q=0, deflate', 'deflate', zlib.MAX_WBITS),
+    ('', None, None),
+])
+def test_event_stream_compression(accept_encoding, encoding, wbits):
+    request = HTTPServerRequest(
+        uri='/build/gh/org/repo/main',
+        headers=HTTPHeaders({'Accept-Encoding': accept_encoding}),
+    )
+    transform = EventStreamCompression(request)
+    headers = HTTPHeaders({'Content-Type': 'text/event-stream'})
+    first = b'data: {"phase": "building"}\n\n'
+    status_code, headers, chunk = transform.transform_first_chunk(200, headers, first, False)
+    assert headers['Vary'] == 'Accept-Encoding'
+    if encoding is None:
+        assert 'Content-Encoding' not in headers
+        assert chunk == first
+        return
+    assert headers['Content-Encoding'] == encoding
+
+    # every chunk can be decompressed as soon as it arrives
+    decompressor = zlib.decompressobj(wbits)
+    assert decompressor.decompress(chunk) == first
+    for i in range(3):
+        event = 'data: {"phase": "building", "message": "Step %i\\n"}\n\n' % i
+        chunk = transform.transform_chunk(event.encode('utf8'), False)
+        assert decompressor.decompress(chunk) == event.encode('utf8')
+    decompressor.decompress(transform.transform_chunk(b'', True))
+    assert decompressor.eof
+
+    # other responses are not compressed
+    transform = EventStreamCompression(request)
+    headers = HTTPHeaders({'Content-Type': 'text/html'})
+    status_code, headers, chunk = transform.transform_first_chunk(200, headers, b'<html>', True)
+    assert chunk == b'<html>'
+    assert 'Content-Encoding' not in headers
+
+
+@pytest.mark.gen_test
+def test_unwatched_builds_deleted():
+    watchers = BuildWatchers()
+    build = mock.Mock()
+    build.name = 'build-1'
+
+    # deleted once the last watcher has been gone for the grace period
+    watchers.watch(build)
+    watchers.watch(build)
+    watchers.unwatch(build, 0.05, phase='building')
+    yield gen.sleep(0.1)
+    assert not build.cleanup.called
+    watchers.unwatch(build, 0.05, phase='building')
+    yield gen.sleep(0.1)
+    assert build.cleanup.call_count == 1
+
+    # not deleted if someone watches it again in time
+    build.cleanup.reset_mock()
+    watchers.watch(build)
+    watchers.unwatch(build, 0.05, phase='building')
+    watchers.watch(build)
+    yield gen.sleep(0.1)
+    assert not build.cleanup.called
+
+    # nor if it's nearly done or finished
+    watchers.unwatch(build, 0.05, phase='pushing')
+    watchers.watch(build)
+    watchers.unwatch(build, 0.05, phase='building', finished=True)
+    yield gen.sleep(0.1)
+    assert not build.cleanup.called
+    assert not watchers._counts
+    assert not watchers._pending
+
+
+def mock_build_pod(name, phase='Running', age=0):
+    pod = mock.Mock()
+    pod.metadata.name = name
+    pod.metadata.deletion_timestamp = None
+    pod.metadata.annotations = {'binder-repo': 'https://github.com/org/repo'}
+    pod.status.phase = phase
+    pod.status.start_time = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(seconds=age)
+    return pod
+
+
+@pytest.mark.gen_test
+def test_build_cleaner():
+    kube = mock.Mock()
+    cleaner = BuildCleaner(kube, 'binder', max_age=10)
+    cleaner.main_loop = IOLoop.current()
+
+    def deleted():
+        names = [call[1]['name'] for call in kube.delete_namespaced_pod.call_args_list]
+        kube.delete_namespaced_pod.reset_mock()
+        return sorted(names)
+
+    cleaner._reset([
+        mock_build_pod('done', 'Succeeded'),
+        mock_build_pod('old', age=11),
+        mock_build_pod('running', age=9.5),
+        mock_build_pod('new'),
+    ])
+    yield gen.sleep(0.05)
+    assert deleted() == ['done', 'old']
+    # the deletions are seen by the watch
+    cleaner._update(mock_build_pod('done', 'Succeeded'), deleted=True)
+    cleaner._update(mock_build_pod('old', age=11), deleted=True)
+
+    # stopped pods are deleted as soon as the event arrives
+    cleaner._update(mock_build_pod('new', 'Failed'))
+    # repeated events don't delete twice
+    cleaner._update(mock_build_pod('new', 'Failed'))
+    yield gen.sleep(0.05)
+    assert deleted() == ['new']
+
+    # running pods are deleted when they reach max_age
+    yield gen.sleep(0.5)
+    assert deleted() == ['running']
+    assert not cleaner._expiry
+    cleaner.stop()
+
+
+@pytest.mark.gen_test
+def test_check_repo_size():
+    events = []
+
+    async def emit(data):
+        events.append(data)
+
+    handler = mock.Mock(
+        settings={'max_repo_size': 10 * 1024 * 1024},
+        repo_url='https://github.com/org/big',
+        emit=emit,
+    )
+    handler.fail = lambda message: BuildHandler.fail(handler, message)
+    provider = mock.Mock()
+
+    async def get_repo_size():
+        return size
+
+    provider.get_repo_size = get_repo_size
+
+    size = 5 * 1024 * 1024
+    ok = yield BuildHandler.check_repo_size(handler, provider)
+    assert ok
+    assert events == []
+
+    size = 20 * 1024 * 1024
+    ok = yield BuildHandler.check_repo_size(handler, provider)
+    assert not ok
+    assert events == [{
+        'phase': 'failed',
+        'message': 'Repository https://github.com/org/big is too big to build (20 MB, limit 10 MB).\n',
+    }]
@@ -0,0 +1,416 @@
+"""Test launcher"""
+import io
+import json
+import time
+from unittest import mock
+
+import pytest
+from tornado import gen, web
+from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest, HTTPResponse
+from tornado.httpserver import HTTPServer
+from tornado.locks import Event
+from tornado.testing import bind_unused_port
+
+from binderhub.launcher import HubAPIClient, LaunchState, Launcher, hub_api_endpoint
+from binderhub.utils import CircuitOpen
+
+
+def mock_event_stream(launcher, events):
+    """Mock progress_client.fetch sending events to the request's streaming_callback"""
+    async def fetch(req, *args, **kwargs):
+        for event in events:
+            # split events across chunks
+            data = 'data: {}\n\n'.format(json.dumps(event)).encode('utf8')
+            req.streaming_callback(data[:5])
+            req.streaming_callback(data[5:])
+        return HTTPResponse(req, 200)
+    return mock.patch.object(launcher.progress_client, 'fetch', fetch)
+
+
+@pytest.mark.gen_test
+def test_wait_for_progress():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc')
+    received = []
+
+    async def event_callback(event):
+        received.append(event['message'])
+
+    with mock_event_stream(launcher, [
+        {'progress': 0, 'message': 'Server requested'},
+        {'progress': 50, 'message': 'Pulling image'},
+        {'progress': 100, 'ready': True, 'message': 'Server ready'},
+    ]):
+        ready = yield launcher.wait_for_progress('user', '', event_callback)
+    assert ready
+    assert received == ['Server requested', 'Pulling image']
+
+    with mock_event_stream(launcher, [{'failed': True, 'message': 'Spawn failed'}]):
+        ready = yield launcher.wait_for_progress('user', 'named')
+    assert ready is False
+
+    # stream ends before the server is ready
+    with mock_event_stream(launcher, [{'message': 'Server requested'}]):
+        with pytest.raises(ValueError):
+            yield launcher.wait_for_progress('user')
+
+
+@pytest.mark.gen_test
+def test_progress_streams_do_not_block_other_requests():
+    spawned = Event()
+
+    class ProgressHandler(web.RequestHandler):
+        async def get(self, username):
+            await spawned.wait()
+            self.write('data: {}\n\n'.format(json.dumps({'ready': True})))
+
+    class OtherHandler(web.RequestHandler):
+        def get(self):
+            self.write('ok')
+
+    app = web.Application([
+        (r'/hub/api/users/([^/]+)/server/progress', ProgressHandler),
+        (r'/other', OtherHandler),
+    ])
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    url = 'http://127.0.0.1:%i/' % port
+    launcher = Launcher(hub_url=url, hub_api_token='abc')
+    try:
+        # more pending streams than the shared client has connections
+        streams = [
+            gen.convert_yielded(launcher.wait_for_progress('user-%i' % i))
+            for i in range(20)
+        ]
+        yield gen.sleep(0.1)
+        resp = yield AsyncHTTPClient().fetch(url + 'other', request_timeout=5)
+        assert resp.body == b'ok'
+        assert not any(stream.done() for stream in streams)
+        spawned.set()
+        ready = yield streams
+        assert all(ready)
+    finally:
+        server.stop()
+
+
+@pytest.mark.gen_test
+def test_user_pool():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', user_pool_size=2)
+    created = []
+    deleted = []
+
+    async def create_hub_user(username):
+        created.append(username)
+
+    async def delete_hub_user(username):
+        deleted.append(username)
+
+    with mock.patch.object(launcher, 'create_hub_user', create_hub_user), \
+            mock.patch.object(launcher, 'delete_hub_user', delete_hub_user):
+        yield launcher.fill_user_pool()
+        assert len(created) == 2
+        assert all(name.startswith('binder-') for name in created)
+
+        assert launcher.claim_pooled_user() == created[0]
+        # the pool is refilled in the background
+        yield launcher.fill_user_pool()
+        assert len(created) == 3
+
+        # expired users are deleted
+        with mock.patch('time.monotonic', return_value=time.monotonic() + launcher.user_pool_max_age):
+            assert launcher.claim_pooled_user() is None
+        # let the background deletions and refill finish
+        yield gen.sleep(0.1)
+        assert deleted == created[1:3]
+
+
+@pytest.mark.gen_test
+def test_warm_pool():
+    launcher = Launcher(
+        hub_url='http://hub.invalid/', hub_api_token='abc',
+        warm_pool_size=1, warm_pool_min_launches=2, warm_pool_max_images=1,
+    )
+    launched = []
+    original_launch = launcher.launch
+
+    async def launch(image, username, server_name='', repo_url='', event_callback=None, use_warm_pool=True):
+        if use_warm_pool:
+            return await original_launch(image, username, repo_url=repo_url)
+        launched.append(username)
+        return {'image': image, 'repo_url': repo_url, 'token': 'abc', 'url': 'http://hub.invalid/user/' + username}
+
+    for i in range(3):
+        launcher.record_launch('popular:1', 'https://github.com/org/popular')
+    launcher.record_launch('unpopular:1', 'https://github.com/org/unpopular')
+    launcher.record_launch('less-popular:1', 'https://github.com/org/less-popular')
+    launcher.record_launch('less-popular:1', 'https://github.com/org/less-popular')
+    assert launcher.popular_images() == {'popular:1'}
+
+    with mock.patch.object(launcher, 'launch', launch):
+        yield launcher.fill_warm_pool('popular:1')
+        yield launcher.fill_warm_pool('unpopular:1')
+        assert len(launched) == 1
+        assert launched[0].startswith('org-popular-')
+
+        server_info = yield launcher.launch('popular:1', 'someone', repo_url='https://github.com/org/popular')
+        assert server_info['url'].endswith(launched[0])
+        assert 'username' not in server_info
+        # let the background refill finish
+        yield gen.sleep(0.1)
+    assert len(launched) == 2
+
+
+@pytest.mark.gen_test
+def test_reap_warm_servers():
+    launcher = Launcher(
+        hub_url='http://hub.invalid/', hub_api_token='abc',
+        warm_pool_size=2, warm_pool_min_launches=1, warm_pool_max_age=60,
+    )
+    launcher.record_launch('popular:1', 'https://github.com/org/popular')
+    now = time.monotonic()
+    launcher._warm_servers['popular:1'].extend([
+        ({'username': 'expired'}, now - 61),
+        ({'username': 'fresh'}, now),
+    ])
+    launcher._warm_servers['forgotten:1'].append(({'username': 'unpopular'}, now))
+    deleted = []
+
+    async def delete_hub_user(username):
+        deleted.append(username)
+
+    with mock.patch.object(launcher, 'delete_hub_user', delete_hub_user):
+        launcher.reap_warm_servers()
+        # let the background deletions run
+        yield gen.sleep(0.1)
+    assert sorted(deleted) == ['expired', 'unpopular']
+    assert [info['username'] for info, created in launcher._warm_servers['popular:1']] == ['fresh']
+    assert 'forgotten:1' not in launcher._warm_servers
+
+
+def test_unclaimed_warm_servers():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', warm_pool_size=2)
+    now = time.monotonic()
+    launcher._warm_servers['registry/repo:1'].extend([({'username': 'a'}, now), ({'username': 'b'}, now)])
+    launcher._warm_servers['registry/repo:2'].append(({'username': 'c'}, now))
+    launcher._warm_servers['registry/other:1'].append(({'username': 'd'}, now))
+    assert launcher.unclaimed_warm_servers('registry/repo') == 3
+    assert launcher.unclaimed_warm_servers('registry/missing') == 0
+
+
+@pytest.mark.parametrize(
+    'url, endpoint', [
+        ('users/abc-123', 'users/{name}'),
+        ('users/abc-123/servers/', 'users/{name}/servers/{server}'),
+        ('users/abc-123/servers/named/progress', 'users/{name}/servers/{server}/progress'),
+        ('users/abc-123/server/progress', 'users/{name}/server/progress'),
+        ('info', 'info'),
+    ]
+)
+def test_hub_api_endpoint(url, endpoint):
+    assert hub_api_endpoint(url) == endpoint
+
+
+@pytest.mark.gen_test
+def test_hub_client_limits_concurrency():
+    client = HubAPIClient(max_concurrent_requests=1, queue_timeout=0.05)
+    request_done = gen.Future()
+
+    async def fetch(req):
+        await request_done
+        return HTTPResponse(req, 200)
+
+    req = HTTPRequest('http://hub.invalid/hub/api/users/abc')
+    with mock.patch.object(client.http_client, 'fetch', fetch):
+        first = gen.convert_yielded(client.fetch(req))
+        # let the first request start
+        yield gen.moment
+        with pytest.raises(web.HTTPError) as exc_info:
+            yield client.fetch(req)
+        assert exc_info.value.status_code == 503
+        request_done.set_result(None)
+        resp = yield first
+    assert resp.code == 200
+
+
+@pytest.mark.gen_test
+def test_hub_client_circuit_breaker():
+    client = HubAPIClient(circuit_breaker_threshold=2)
+    calls = []
+
+    async def fetch(req):
+        calls.append(req)
+        raise HTTPError(502)
+
+    req = HTTPRequest('http://hub.invalid/hub/api/users/abc')
+    with mock.patch.object(client.http_client, 'fetch', fetch):
+        for i in range(2):
+            with pytest.raises(HTTPError):
+                yield client.fetch(req)
+        with pytest.raises(CircuitOpen):
+            yield client.fetch(req)
+    assert len(calls) == 2
+
+
+@pytest.mark.gen_test
+def test_launch_stage_metrics():
+    from prometheus_client import REGISTRY
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', create_user=True)
+
+    def stage_count(stage, just_built):
+        return REGISTRY.get_sample_value(
+            'binderhub_launch_stage_time_seconds_count',
+            {'stage': stage, 'just_built': just_built},
+        ) or 0
+
+    async def create_hub_user(username):
+        pass
+
+    async def api_request(url, *args, **kwargs):
+        return HTTPResponse(HTTPRequest(url), 201)
+
+    before = {stage: stage_count(stage, 'true') for stage in ('user_create', 'spawn_request', 'spawn_wait')}
+    with mock.patch.object(launcher, 'create_hub_user', create_hub_user), \
+            mock.patch.object(launcher, 'api_request', api_request):
+        server_info = yield launcher.launch('image:1', 'user', just_built=True)
+    assert server_info['url'] == 'http://hub.invalid/user/user/'
+    assert stage_count('user_create', 'true') == before['user_create'] + 1
+    assert stage_count('spawn_request', 'true') == before['spawn_request'] + 1
+    # the server started right away, so there was nothing to wait for
+    assert stage_count('spawn_wait', 'true') == before['spawn_wait']
+
+
+@pytest.mark.gen_test
+def test_launch_batch():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', create_user=True, retry_delay=0)
+    running = 0
+    max_running = 0
+    attempts = []
+    progress = []
+    warm_pool_used = set()
+
+    async def launch(image, username, repo_url='', use_warm_pool=True, just_built=False, state=None):
+        nonlocal running, max_running
+        warm_pool_used.add(use_warm_pool)
+        running += 1
+        max_running = max(running, max_running)
+        attempts.append(username)
+        first_attempt = len(attempts) == 1
+        await gen.sleep(0.01)
+        running -= 1
+        if first_attempt:
+            raise web.HTTPError(500, "first launch fails")
+        return {'image': image, 'repo_url': repo_url, 'token': username, 'url': 'http://hub.invalid/user/' + username}
+
+    async def progress_callback(launched, failed):
+        progress.append((launched, failed))
+
+    with mock.patch.object(launcher, 'launch', launch):
+        servers = yield launcher.launch_batch(
+            'image:1', 5, repo_url='https://github.com/org/repo',
+            concurrency=2, progress_callback=progress_callback,
+        )
+    assert len(servers) == 5
+    # the failed launch was retried with the same user
+    assert len(attempts) == 6
+    assert len(set(attempts)) == 5
+    assert len({server['url'] for server in servers}) == 5
+    assert max_running == 2
+    assert progress[-1] == (5, 0)
+    # batch launches leave warm pools to interactive launches
+    assert warm_pool_used == {False}
+
+    launcher.create_user = False
+    with pytest.raises(web.HTTPError):
+        yield launcher.launch_batch('image:1', 5)
+
+
+@pytest.mark.gen_test
+def test_spawn_admission():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', max_pending_spawns=2)
+    positions = {}
+
+    def queue_callback(name):
+        async def callback(event):
+            positions.setdefault(name, []).append(event['queue_position'])
+        return callback
+
+    yield launcher.acquire_spawn_slot()
+    yield launcher.acquire_spawn_slot()
+    assert launcher._pending_spawns == 2
+
+    waiting = [
+        gen.convert_yielded(launcher.acquire_spawn_slot(queue_callback(name)))
+        for name in ('a', 'b')
+    ]
+    yield gen.moment
+    assert not any(f.done() for f in waiting)
+    assert positions == {'a': [1], 'b': [2]}
+
+    launcher.release_spawn_slot()
+    yield waiting[0]
+    yield gen.moment
+    assert not waiting[1].done()
+    assert positions == {'a': [1], 'b': [2, 1]}
+
+    launcher.release_spawn_slot()
+    yield waiting[1]
+    assert launcher._pending_spawns == 2
+    assert not launcher._spawn_queue
+
+
+@pytest.mark.gen_test
+def test_hub_busy_retried():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', retry_delay=0)
+    responses = [429, 201]
+
+    async def fetch(req, endpoint='unknown'):
+        code = responses.pop(0)
+        response = HTTPResponse(req, code, headers={'Retry-After': '0'})
+        if code >= 400:
+            raise HTTPError(code, response=response)
+        return response
+
+    with mock.patch.object(launcher.hub_client, 'fetch', fetch):
+        resp = yield launcher.api_request('users/abc/servers/', method='POST', body=b'{}')
+    assert resp.code == 201
+
+
+@pytest.mark.gen_test
+def test_launch_resumes():
+    launcher = Launcher(hub_url='http://hub.invalid/', hub_api_token='abc', create_user=True,
+                        use_progress_stream=False)
+    requests = []
+    server_states = [
+        # the first attempt fails while waiting for the server
+        HTTPError(599),
+        {'ready': True, 'pending': None},
+    ]
+
+    async def api_request(url, method='GET', body=None, **kwargs):
+        requests.append((method, url))
+        if method == 'POST':
+            return HTTPResponse(HTTPRequest(url), 202 if url.endswith('servers/') else 201)
+        server = server_states.pop(0)
+        if isinstance(server, Exception):
+            raise server
+        return HTTPResponse(HTTPRequest(url), 200, buffer=io.BytesIO(
+            json.dumps({'servers': {'': server}}).encode('utf8')
+        ))
+
+    state = LaunchState()
+    with mock.patch.object(launcher, 'api_request', api_request):
+        with pytest.raises(web.HTTPError):
+            yield launcher.launch('image:1', 'user-abc', state=state)
+        assert state.step == LaunchState.SPAWN_REQUESTED
+        token = state.data['token']
+        # the retry waits for the same server, without creating another user or server
+        server_info = yield launcher.launch('image:1', 'user-xyz', state=state)
+    assert state.step == LaunchState.READY
+    assert server_info['url'] == 'http://hub.invalid/user/user-abc/'
+    assert server_info['token'] == token
+    assert requests == [
+        ('POST', 'users/user-abc'),
+        ('POST', 'users/user-abc/servers/'),
+        ('GET', 'users/user-abc'),
+        ('GET', 'users/user-abc'),
+    ]
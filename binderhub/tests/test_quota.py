@@ -0,0 +1,188 @@
+"""Test launch quotas"""
+import json
+import os
+import time
+from unittest import mock
+
+import pytest
+from tornado import gen
+
+from binderhub.quota import LaunchQuota, QuotaTiers, image_repo
+
+
+def test_image_repo():
+    assert image_repo('registry/prefix-repo-abc123:ref') == 'registry/prefix-repo-abc123'
+
+
+def test_pod_counts():
+    quota = LaunchQuota(mock.Mock(), 'binder')
+    quota._reset({'a': {'repo1'}, 'b': {'repo1'}, 'c': {'repo2'}})
+    assert quota.count('repo1') == 2
+    assert quota.total == 3
+
+    # a pod changes phase without changing its repo
+    quota._set_pod('a', {'repo1'})
+    assert quota.count('repo1') == 2
+    quota._set_pod('d', {'repo2'})
+    assert quota.count('repo2') == 2
+    quota._set_pod('a', None)
+    assert quota.count('repo1') == 1
+    assert quota.total == 3
+
+
+@pytest.mark.gen_test
+def test_acquire_waits_for_server_to_stop():
+    quota = LaunchQuota(mock.Mock(), 'binder')
+    quota._reset({'a': {'repo'}, 'b': {'repo'}})
+    positions = {}
+
+    def position_callback(name):
+        async def callback(position):
+            positions.setdefault(name, []).append(position)
+        return callback
+
+    # over quota and not allowed to wait
+    admitted = yield quota.acquire('repo', 2, timeout=0)
+    assert not admitted
+
+    waiting = [
+        gen.convert_yielded(quota.acquire('repo', 2, timeout=10, position_callback=position_callback(name)))
+        for name in ('first', 'second')
+    ]
+    yield gen.moment
+    assert not any(f.done() for f in waiting)
+    assert positions == {'first': [1], 'second': [2]}
+
+    # a server stops, the first launch in the queue is admitted
+    quota._set_pod('a', None)
+    admitted = yield waiting[0]
+    assert admitted
+    # the admitted launch counts until it is released
+    assert quota.count('repo') == 2
+    yield gen.moment
+    assert not waiting[1].done()
+    assert positions['second'] == [2, 1]
+
+    # the launch finished, its server is now running
+    quota._set_pod('c', {'repo'})
+    quota.release('repo')
+    yield gen.moment
+    assert not waiting[1].done()
+
+    quota._set_pod('b', None)
+    admitted = yield waiting[1]
+    assert admitted
+    quota.release('repo')
+    assert quota.count('repo') == 1
+    assert not quota._queues
+
+
+@pytest.mark.gen_test
+def test_acquire_timeout():
+    quota = LaunchQuota(mock.Mock(), 'binder')
+    quota._reset({'a': {'repo'}})
+    admitted = yield quota.acquire('repo', 1, timeout=0.05)
+    assert not admitted
+    assert not quota._queues
+    # other repos are not affected
+    admitted = yield quota.acquire('other', 1, timeout=0)
+    assert admitted
+
+
+@pytest.mark.gen_test
+def test_acquire_batch():
+    quota = LaunchQuota(mock.Mock(), 'binder')
+    quota._reset({'a': {'repo'}})
+    # the whole batch has to fit
+    admitted = yield quota.acquire('repo', 3, timeout=0, count=3)
+    assert not admitted
+    admitted = yield quota.acquire('repo', 3, timeout=0, count=2)
+    assert admitted
+    assert quota.count('repo') == 3
+    # the reserved slots can't be taken by other launches
+    admitted = yield quota.acquire('repo', 3, timeout=0)
+    assert not admitted
+    quota.release('repo', 2)
+    assert quota.count('repo') == 1
+
+
+@pytest.mark.gen_test
+def test_unclaimed_servers_not_counted():
+    unclaimed = {'repo': 1}
+    quota = LaunchQuota(mock.Mock(), 'binder', unclaimed_servers=lambda repo: unclaimed.get(repo, 0))
+    quota._reset({'a': {'repo'}, 'warm': {'repo'}})
+    assert quota.count('repo') == 1
+    # a launch doesn't wait behind the unclaimed warm server
+    admitted = yield quota.acquire('repo', 2, timeout=0)
+    assert admitted
+    # and takes it, which uses up the quota
+    unclaimed['repo'] = 0
+    assert quota.count('repo') == 3
+    quota.release('repo')
+    assert quota.count('repo') == 2
+    admitted = yield quota.acquire('repo', 2, timeout=0)
+    assert not admitted
+
+
+@pytest.mark.gen_test
+def test_acquire_unsynced():
+    quota = LaunchQuota(mock.Mock(), 'binder')
+    quota.SYNC_TIMEOUT = 0.1
+    # launches wait for the first list of pods only once
+    start = time.monotonic()
+    admitted = yield [quota.acquire('repo', 1, timeout=0), quota.acquire('other', 1, timeout=0)]
+    assert admitted == [True, True]
+    assert 0.1 <= time.monotonic() - start < 1
+    start = time.monotonic()
+    admitted = yield quota.acquire('third', 1, timeout=0)
+    assert admitted
+    assert time.monotonic() - start < 0.05
+
+
+@pytest.mark.gen_test
+def test_acquire_while_listing_fails():
+    kube = mock.Mock()
+    kube.list_namespaced_pod.side_effect = RuntimeError("forbidden")
+    quota = LaunchQuota(kube, 'binder')
+    quota.start()
+    try:
+        start = time.monotonic()
+        admitted = yield quota.acquire('repo', 1, timeout=0)
+        assert admitted
+        assert time.monotonic() - start < quota.SYNC_TIMEOUT
+    finally:
+        quota.stop()
+
+
+def test_quota_tiers(tmpdir):
+    path = str(tmpdir.join('quotas.json'))
+    with open(path, 'w') as f:
+        json.dump({
+            'tiers': [
+                {'pattern': 'github.com/org/repo$', 'quota': 0},
+                {'pattern': 'github.com/org/', 'quota': 500},
+                {'pattern': 'gitlab.com/course/', 'quota': 200},
+            ],
+        }, f)
+    tiers = QuotaTiers(path, default=100, check_interval=0)
+    assert tiers.quota_for('github.com/org/repo') == 0
+    assert tiers.quota_for('github.com/ORG/other') == 500
+    assert tiers.quota_for('github.com/org/repo-2') == 500
+    assert tiers.quota_for('gitlab.com/course/sub/repo') == 200
+    assert tiers.quota_for('github.com/someone/org/') == 100
+
+    # the file is reloaded when it changes
+    with open(path, 'w') as f:
+        json.dump({'default': 50, 'tiers': [{'pattern': 'github.com/org/', 'quota': 10}]}, f)
+    os.utime(path, (0, 0))
+    assert tiers.quota_for('github.com/org/repo') == 10
+    assert tiers.quota_for('github.com/someone/repo') == 50
+
+    # invalid files are ignored
+    with open(path, 'w') as f:
+        json.dump({'tiers': [{'pattern': '(', 'quota': 10}]}, f)
+    os.utime(path, (1, 1))
+    assert tiers.quota_for('github.com/org/repo') == 10
+
+    with pytest.raises(ValueError):
+        QuotaTiers(path)
@@ -1,12 +1,20 @@
-from unittest import TestCase
+import hashlib
+import hmac
+import io
+import json
+from unittest import TestCase, mock
 
 from urllib.parse import quote
 import pytest
+from tornado.httpclient import HTTPRequest, HTTPResponse
 from tornado.ioloop import IOLoop
+from traitlets.config import Config
 
 from binderhub.repoproviders import (
-    tokenize_spec, strip_suffix, GitHubRepoProvider, GitRepoProvider, GitLabRepoProvider, GistRepoProvider
+    tokenize_spec, strip_suffix, canonical_repo_identity, environment_hash,
+    GitHubRepoProvider, GitRepoProvider, GitLabRepoProvider, GistRepoProvider
 )
+from binderhub.utils import CircuitOpen
 
 
 # General string processing
@@ -117,7 +125,8 @@ def test_git_ref():
 
     provider = GitRepoProvider(spec=spec)
     slug = provider.get_build_slug()
-    assert slug == 'https://github.com/jupyterhub/zero-to-jupyterhub-k8s'
+    # same slug as the GitHub provider
+    assert slug == 'jupyterhub-zero-to-jupyterhub-k8s'
     full_url = provider.get_repo_url()
     assert full_url == 'https://github.com/jupyterhub/zero-to-jupyterhub-k8s'
     ref = IOLoop().run_sync(provider.get_resolved_ref)
@@ -161,3 +170,212 @@ def test_gist_secret():
 
     provider = GistRepoProvider(spec=spec, allow_secret_gist=True)
     assert IOLoop().run_sync(provider.get_resolved_ref) is not None
+
+
+def test_github_webhook():
+    payload = {
+        'ref': 'refs/heads/feature/webhook',
+        'after': 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603',
+        'repository': {'full_name': 'binderhub-ci-repos/webhook-test'},
+    }
+    spec, resolved_ref = GitHubRepoProvider.spec_from_webhook({'X-GitHub-Event': 'push'}, payload)
+    assert spec == 'binderhub-ci-repos/webhook-test/feature/webhook'
+    assert resolved_ref == payload['after']
+    assert GitHubRepoProvider.spec_from_webhook({'X-GitHub-Event': 'ping'}, {}) is None
+
+    body = json.dumps(payload).encode('utf8')
+    signature = 'sha256=' + hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+    provider = GitHubRepoProvider(spec=spec, webhook_secret='secret')
+    assert provider.verify_webhook({'X-Hub-Signature-256': signature}, body)
+    assert not provider.verify_webhook({'X-Hub-Signature-256': signature}, body + b' ')
+    assert not provider.verify_webhook({}, body)
+    assert not GitHubRepoProvider(spec=spec).verify_webhook({'X-Hub-Signature-256': signature}, body)
+
+    # resolving a pushed ref does not make an API request
+    provider.set_pushed_ref(resolved_ref)
+    provider = GitHubRepoProvider(spec=spec)
+    assert IOLoop().run_sync(provider.get_resolved_ref) == resolved_ref
+
+    # deleting the ref removes it from the cache
+    provider.set_pushed_ref(None)
+    assert provider.get_ref_cache_key() not in GitHubRepoProvider.cache
+
+
+def test_gitlab_webhook():
+    payload = {
+        'ref': 'refs/heads/master',
+        'after': 'b3344b7f17c335a817c5d7608c5e47fd7cabc023',
+        'project': {'path_with_namespace': 'gitlab-org/gitlab-ce'},
+    }
+    spec, resolved_ref = GitLabRepoProvider.spec_from_webhook({'X-Gitlab-Event': 'Push Hook'}, payload)
+    assert spec == 'gitlab-org%2Fgitlab-ce/master'
+
+    provider = GitLabRepoProvider(spec=spec, webhook_secret='secret')
+    assert provider.verify_webhook({'X-Gitlab-Token': 'secret'}, b'')
+    assert not provider.verify_webhook({'X-Gitlab-Token': 'wrong'}, b'')
+
+    provider.set_pushed_ref(resolved_ref)
+    provider = GitLabRepoProvider(spec=spec)
+    assert IOLoop().run_sync(provider.get_resolved_ref) == resolved_ref
+    provider.set_pushed_ref(None)
+
+
+def test_circuit_breaker_stale_ref():
+    provider = GitHubRepoProvider(spec='binderhub-ci-repos/stale-test/master', hostname='github.invalid')
+    assert provider.get_last_resolved_ref() is None
+    provider.set_pushed_ref('f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603')
+    assert provider.get_last_resolved_ref() == 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
+    provider.set_pushed_ref(None)
+
+    breaker = provider.circuit_breaker
+    for i in range(provider.circuit_breaker_threshold):
+        breaker.record_failure()
+    try:
+        with pytest.raises(CircuitOpen):
+            IOLoop().run_sync(provider.get_resolved_ref)
+    finally:
+        breaker.record_success()
+
+
+def test_repo_size_cached():
+    provider = GitHubRepoProvider(spec='binderhub-ci-repos/size-test/master')
+    calls = []
+
+    async def fetch_size():
+        calls.append(1)
+        return 1024
+
+    for i in range(2):
+        size = IOLoop().run_sync(lambda: provider._cached_repo_size('size-test', fetch_size))
+        assert size == 1024
+    assert len(calls) == 1
+
+
+def test_environment_hash():
+    tree = [
+        ('README.md', 'blob', 'a1'),
+        ('requirements.txt', 'blob', 'b1'),
+        ('notebooks', 'tree', 'c1'),
+    ]
+    h = environment_hash(tree)
+    # changing content doesn't change the environment
+    assert environment_hash([('README.md', 'blob', 'a2')] + tree[1:]) == h
+    assert environment_hash(tree[:2] + [('notebooks', 'tree', 'c2')]) == h
+    # changing an environment file does
+    assert environment_hash(tree[:1] + [('requirements.txt', 'blob', 'b2')] + tree[2:]) != h
+    assert environment_hash(tree + [('postBuild', 'blob', 'd1')]) != h
+
+    # only the binder directory counts if there is one
+    binder_tree = tree + [('binder', 'tree', 'e1')]
+    h = environment_hash(binder_tree)
+    assert environment_hash(tree[:1] + [('requirements.txt', 'blob', 'b2')] + binder_tree[2:]) == h
+    assert environment_hash(tree + [('binder', 'tree', 'e2')]) != h
+
+
+def test_github_environment_hash():
+    provider = GitHubRepoProvider(spec='binderhub-ci-repos/env-test/master')
+    provider.resolved_ref = 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
+    requested = []
+
+    async def github_api_request(api_url, etag=None):
+        requested.append(api_url)
+        body = json.dumps({'tree': [
+            {'path': 'requirements.txt', 'type': 'blob', 'sha': 'b1'},
+            {'path': 'index.ipynb', 'type': 'blob', 'sha': 'a1'},
+        ]})
+        return HTTPResponse(HTTPRequest(api_url), 200, buffer=io.BytesIO(body.encode('utf8')))
+
+    with mock.patch.object(provider, 'github_api_request', github_api_request):
+        h = IOLoop().run_sync(provider.get_environment_hash)
+    assert h == environment_hash([('requirements.txt', 'blob', 'b1')])
+    assert requested == [
+        'https://api.github.com/repos/binderhub-ci-repos/env-test/git/trees/'
+        'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
+    ]
+
+
+def test_github_repo_size():
+    provider = GitHubRepoProvider(spec='binderhub-ci-repos/size-test/master')
+    requested = []
+
+    async def github_api_request(api_url, etag=None):
+        requested.append(api_url)
+        body = json.dumps({'full_name': 'binderhub-ci-repos/size-test', 'size': 2048})
+        return HTTPResponse(HTTPRequest(api_url), 200, buffer=io.BytesIO(body.encode('utf8')))
+
+    provider.size_cache.pop(provider.get_repo_identity(), None)
+    with mock.patch.object(provider, 'github_api_request', github_api_request):
+        # GitHub reports kilobytes
+        size = IOLoop().run_sync(provider.get_repo_size)
+        assert size == 2048 * 1024
+        # the size is cached
+        assert IOLoop().run_sync(provider.get_repo_size) == size
+    assert requested == ['https://api.github.com/repos/binderhub-ci-repos/size-test']
+    provider.size_cache.pop(provider.get_repo_identity(), None)
+
+
+@pytest.mark.parametrize(
+    'repo_url, identity', [
+        ("https://github.com/User/Repo", "github.com/user/repo"),
+        ("https://GitHub.com/user/repo.git/", "github.com/user/repo"),
+        ("git@github.com:User/Repo.git", "github.com/user/repo"),
+        ("https://token@example.com/User/Repo.git", "example.com/User/Repo"),
+    ]
+)
+def test_canonical_repo_identity(repo_url, identity):
+    assert canonical_repo_identity(repo_url) == identity
+
+
+@pytest.mark.parametrize(
+    'provider_class, spec', [
+        (GitHubRepoProvider, 'User/Repo/master'),
+        (GitHubRepoProvider, 'user/repo.git/master'),
+        (GitRepoProvider, '{}/{}'.format(
+            quote('https://github.com/USER/repo.git', safe=''),
+            'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603',
+        )),
+    ]
+)
+def test_equivalent_specs(provider_class, spec):
+    provider = provider_class(spec=spec)
+    assert provider.get_repo_identity() == 'github.com/user/repo'
+    assert provider.get_build_slug() == 'user-repo'
+
+
+def test_equivalent_gitlab_specs():
+    gitlab = GitLabRepoProvider(spec='{}/master'.format(quote('Group/sub-group/Repo', safe='')))
+    git = GitRepoProvider(spec='{}/{}'.format(
+        quote('https://gitlab.com/group/sub-group/repo.git', safe=''),
+        'b3344b7f17c335a817c5d7608c5e47fd7cabc023',
+    ))
+    assert gitlab.get_repo_identity() == git.get_repo_identity()
+    assert gitlab.get_build_slug() == git.get_build_slug() == 'group-sub_-group-repo'
+
+
+def test_equivalent_specs_configured_hostname():
+    config = Config()
+    config.GitLabRepoProvider.hostname = 'GitLab.example.org'
+    spec = '{}/{}'.format(
+        quote('https://gitlab.example.org/group/sub-group/repo.git', safe=''),
+        'b3344b7f17c335a817c5d7608c5e47fd7cabc023',
+    )
+    # without the config, the self-hosted GitLab isn't recognised
+    assert GitRepoProvider(spec=spec).get_build_slug() == 'gitlab.example.org/group/sub-group/repo'
+    git = GitRepoProvider(spec=spec, config=config)
+    gitlab = GitLabRepoProvider(
+        spec='{}/master'.format(quote('group/sub-group/repo', safe='')), config=config,
+    )
+    assert git.get_build_slug() == gitlab.get_build_slug() == 'group-sub_-group-repo'
+
+
+def test_equivalent_specs_configured_github_hostname():
+    config = Config()
+    config.GitHubRepoProvider.hostname = 'ghe.example.com'
+    github = GitHubRepoProvider(spec='User/Repo/master', config=config)
+    # paths of self-hosted instances keep their case in identities
+    git = GitRepoProvider(spec='{}/{}'.format(
+        quote('https://ghe.example.com/User/Repo', safe=''),
+        'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603',
+    ), config=config)
+    assert git.get_repo_identity() == 'ghe.example.com/User/Repo'
+    assert git.get_build_slug() == github.get_build_slug() == 'user-repo'
@@ -0,0 +1,95 @@
+"""Test the build status API"""
+import json
+from unittest import mock
+
+import pytest
+from tornado import gen, web
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from traitlets.config import Config
+
+from binderhub.builder import BuildHandler, EventBuffer
+from binderhub.repoproviders import FakeProvider, GitHubRepoProvider
+from binderhub.status import BuildStatusHandler
+
+
+@pytest.fixture
+def status_url(io_loop):
+    app = web.Application([
+        (r'/api/builds/([^/]+)/(.+)', BuildStatusHandler),
+    ], auth_enabled=False, use_registry=False, event_log=None,
+        docker_image_prefix='prefix-', repo_providers={'fake': FakeProvider, 'gh': GitHubRepoProvider},
+        traitlets_config=Config(),
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    yield 'http://127.0.0.1:%i/api/builds/fake/org/repo/main' % port
+    server.stop()
+
+
+@pytest.mark.gen_test
+def test_build_status(status_url):
+    key = 'fake:org/repo/main'
+    buffer = EventBuffer(key)
+    buffer.append('{}', {'phase': 'launching', 'queue_position': 2})
+    BuildHandler.latest_streams.set(key, buffer.status)
+    client = AsyncHTTPClient()
+
+    def get_image_name(self, provider, ref):
+        return 'prefix-fake:' + ref
+
+    try:
+        # nothing cached for the spec
+        resp = yield client.fetch(status_url)
+        status = json.loads(resp.body.decode('utf8'))
+        assert status['resolved_ref'] == 'unknown'
+        assert status['image_found'] == 'unknown'
+        assert status['phase'] == 'launching'
+
+        with mock.patch.object(FakeProvider, 'get_last_resolved_ref', lambda self: '1a2b3c4d5e6f'), \
+                mock.patch.object(BuildStatusHandler, 'get_image_name', get_image_name):
+            resp = yield client.fetch(status_url)
+            status = json.loads(resp.body.decode('utf8'))
+            assert status['resolved_ref'] == '1a2b3c4d5e6f'
+            assert status['image_found'] == 'unknown'
+            assert status['phase'] == 'launching'
+            assert status['queue_position'] == 2
+            assert status['in_progress']
+
+            BuildHandler.found_images.set('prefix-fake:1a2b3c4d5e6f', True)
+            resp = yield client.fetch(status_url)
+            status = json.loads(resp.body.decode('utf8'))
+            assert status['image_found'] is True
+
+            # long-polling returns when the stream finishes
+            waiting = gen.convert_yielded(client.fetch(status_url + '?wait=10'))
+            yield gen.sleep(0.1)
+            assert not waiting.done()
+            buffer.append('{}', {'phase': 'ready'})
+            buffer.finish()
+            resp = yield waiting
+            status = json.loads(resp.body.decode('utf8'))
+            assert status['phase'] == 'ready'
+            assert status['queue_position'] is None
+            assert not status['in_progress']
+
+            with pytest.raises(HTTPClientError) as exc_info:
+                yield client.fetch(status_url + '?wait=soon')
+            assert exc_info.value.code == 400
+            assert json.loads(exc_info.value.response.body.decode('utf8'))['status_code'] == 400
+    finally:
+        BuildHandler.latest_streams.pop(key, None)
+        BuildHandler.found_images.pop('prefix-fake:1a2b3c4d5e6f', None)
+
+
+@pytest.mark.gen_test
+def test_build_status_invalid_spec(status_url):
+    # a GitHub spec without a ref
+    url = status_url.replace('/fake/org/repo/main', '/gh/org/repo')
+    with pytest.raises(HTTPClientError) as exc_info:
+        yield AsyncHTTPClient().fetch(url)
+    assert exc_info.value.code == 400
+    body = json.loads(exc_info.value.response.body.decode('utf8'))
+    assert body['message'].startswith('Invalid spec org/repo')
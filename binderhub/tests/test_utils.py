@@ -0,0 +1,65 @@
+"""Test utilities"""
+from unittest import mock
+
+import pytest
+from tornado import gen
+
+from binderhub.utils import CircuitBreaker, CircuitOpen, PodWatcher
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=10)
+    with mock.patch('time.monotonic', return_value=100):
+        assert breaker.allow_request()
+        breaker.record_failure()
+        assert not breaker.is_open
+        breaker.record_failure()
+        assert breaker.is_open
+        assert not breaker.allow_request()
+        with pytest.raises(CircuitOpen):
+            breaker.check()
+
+    with mock.patch('time.monotonic', return_value=110):
+        # one probe is allowed through after reset_timeout
+        assert breaker.allow_request()
+        assert not breaker.allow_request()
+        breaker.record_success()
+        assert not breaker.is_open
+        assert breaker.allow_request()
+
+
+@pytest.mark.gen_test
+def test_pod_watcher():
+    calls = []
+
+    class Watcher(PodWatcher):
+        def _pods_listed(self, pods):
+            calls.append(('listed', pods))
+
+        def _pod_changed(self, pod, deleted):
+            calls.append(('changed', pod, deleted))
+
+    kube = mock.Mock()
+    kube.list_namespaced_pod.return_value = mock.Mock(items=['a', 'b'], metadata=mock.Mock(resource_version='7'))
+    watcher = Watcher(kube, 'binder', 'component=test')
+
+    def stream(list_func, namespace, **kwargs):
+        assert kwargs['resource_version'] == '7'
+        assert kwargs['label_selector'] == 'component=test'
+        yield {'type': 'MODIFIED', 'object': 'a'}
+        yield {'type': 'DELETED', 'object': 'b'}
+        # stop after this watch
+        watcher.stop()
+
+    with mock.patch('binderhub.utils.watch.Watch') as Watch:
+        Watch.return_value.stream = stream
+        watcher.start()
+        for i in range(100):
+            if len(calls) == 3:
+                break
+            yield gen.sleep(0.01)
+    assert calls == [
+        ('listed', ['a', 'b']),
+        ('changed', 'a', False),
+        ('changed', 'b', True),
+    ]
@@ -1,5 +1,11 @@
 """Miscellaneous utilities"""
 from collections import OrderedDict
+import threading
+import time
+
+from kubernetes import watch
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
 from traitlets import Integer, TraitError
 
 
@@ -75,6 +81,133 @@ class Cache(OrderedDict):
             self.pop(first_key)
 
 
+class CircuitOpen(Exception):
+    """Raised instead of making a request to a service whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stop sending requests to a service after consecutive failures
+
+    After ``failure_threshold`` consecutive failures the circuit opens,
+    and requests should fail fast instead of waiting for timeouts.
+    Once ``reset_timeout`` seconds have passed,
+    a single request is allowed through to check if the service has recovered.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow_request(self):
+        """Return whether a request should be made"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # half-open: let one request through and re-arm the timer,
+            # so we send at most one probe per reset_timeout
+            self.opened_at = now
+            return True
+        return False
+
+    def check(self):
+        """Raise CircuitOpen if a request should not be made"""
+        if not self.allow_request():
+            raise CircuitOpen("%s is unavailable, not retrying for up to %i seconds"
+                % (self.name, self.reset_timeout))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class PodWatcher:
+    """Follow the pods matching `label_selector` in a background thread
+
+    All the pods are listed, then changes to them are watched
+    until the watch times out after `resync_interval` seconds,
+    at which point they are listed again, in case an event was missed.
+    Subclasses handle the pods on the main loop, in
+    :meth:`_pods_listed` with the result of each list
+    and :meth:`_pod_changed` for each change.
+    """
+
+    # name of the thread, and of the pods in log messages
+    thread_name = 'pod-watch'
+    pods_description = 'pods'
+
+    def __init__(self, kube, namespace, label_selector, resync_interval=300):
+        self.kube = kube
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.resync_interval = resync_interval
+        self.main_loop = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Start watching pods in a background thread"""
+        self.main_loop = IOLoop.current()
+        self._stop_event.clear()
+        thread = threading.Thread(target=self._watch_pods, name=self.thread_name, daemon=True)
+        thread.start()
+
+    def stop(self):
+        """Stop watching pods"""
+        self._stop_event.set()
+
+    def _pods_listed(self, pods):
+        """Handle the list of all the pods"""
+        raise NotImplementedError("Must be overridden in the subclass")
+
+    def _pod_changed(self, pod, deleted):
+        """Handle a change to a pod, `deleted` is whether it's gone"""
+        raise NotImplementedError("Must be overridden in the subclass")
+
+    def _watch_failed(self):
+        """Handle listing or watching the pods failing, before it is retried"""
+        pass
+
+    def _watch_pods(self):
+        """Pass the pods and their changes to the main loop (runs in a thread)"""
+        while not self._stop_event.is_set():
+            w = watch.Watch()
+            try:
+                pods = self.kube.list_namespaced_pod(
+                    self.namespace,
+                    label_selector=self.label_selector,
+                )
+                self.main_loop.add_callback(self._pods_listed, pods.items)
+                for event in w.stream(
+                        self.kube.list_namespaced_pod,
+                        self.namespace,
+                        label_selector=self.label_selector,
+                        resource_version=pods.metadata.resource_version,
+                        timeout_seconds=self.resync_interval,
+                ):
+                    if self._stop_event.is_set():
+                        return
+                    self.main_loop.add_callback(
+                        self._pod_changed, event['object'], event['type'] == 'DELETED',
+                    )
+            except Exception:
+                app_log.exception("Error watching %s", self.pods_description)
+                self.main_loop.add_callback(self._watch_failed)
+                self._stop_event.wait(5)
+            finally:
+                w.stop()
+
+
 def url_path_join(*pieces):
     """Join components of url into a relative url.
 
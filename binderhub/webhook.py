@@ -0,0 +1,63 @@
+"""
+Handler for push webhooks from repo providers
+"""
+import json
+
+from tornado import web
+from tornado.log import app_log
+
+from .base import BaseHandler
+
+
+class WebhookHandler(BaseHandler):
+    """Receive push webhooks and update the resolved-ref cache
+
+    Each push updates the cached ref for the pushed branch or tag,
+    so launching it does not need to ask the provider's API.
+    """
+
+    def check_xsrf_cookie(self):
+        """Webhooks are authenticated by their signature, not cookies"""
+        pass
+
+    async def post(self, provider_prefix):
+        providers = self.settings['repo_providers']
+        if provider_prefix not in providers:
+            raise web.HTTPError(404, "No provider found for prefix %s" % provider_prefix)
+        Provider = providers[provider_prefix]
+
+        try:
+            payload = json.loads(self.request.body.decode('utf8'))
+        except ValueError:
+            raise web.HTTPError(400, "Webhook payload is not JSON")
+
+        try:
+            parsed = Provider.spec_from_webhook(self.request.headers, payload)
+        except NotImplementedError as e:
+            raise web.HTTPError(404, str(e))
+        except (KeyError, TypeError) as e:
+            raise web.HTTPError(400, "Invalid webhook payload: missing %s" % e)
+
+        if parsed is None:
+            # not a push, e.g. a ping when the webhook is set up
+            self.set_status(204)
+            return
+        spec, resolved_ref = parsed
+
+        try:
+            provider = self.get_provider(provider_prefix, spec=spec)
+        except web.HTTPError:
+            raise
+        except Exception as e:
+            raise web.HTTPError(400, "Invalid spec %s: %s" % (spec, e))
+
+        if not provider.verify_webhook(self.request.headers, self.request.body):
+            app_log.warning("Rejecting unverified webhook for %s/%s", provider_prefix, spec)
+            raise web.HTTPError(403, "Webhook signature could not be verified")
+
+        try:
+            provider.set_pushed_ref(resolved_ref)
+        except ValueError as e:
+            raise web.HTTPError(400, str(e))
+        app_log.info("Webhook set ref for %s/%s: %s", provider_prefix, spec, resolved_ref)
+        self.set_status(204)
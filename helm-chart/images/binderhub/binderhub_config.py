@@ -43,6 +43,9 @@ c.BinderHub.use_registry = get_config('binder.use-registry', True)
 c.BinderHub.per_repo_quota = get_config('binder.per-repo-quota', 0)
 
 c.BinderHub.builder_image_spec = get_config('binder.repo2docker-image')
+builder_image_pull_policy = get_config('binder.repo2docker-image-pull-policy', None)
+if builder_image_pull_policy:
+    c.BinderHub.builder_image_pull_policy = builder_image_pull_policy
 c.BinderHub.build_node_selector = get_config('binder.build-node-selector', {})
 c.BinderHub.log_tail_lines = get_config('binder.log-tail-lines', 100)
 